@@ -1,11 +1,29 @@
 import openai
+import cProfile
+import io
 import json
+import logging
+import marshal
+import os
+import pstats
+import sys
 import streamlit as st
 import requests
 from urllib.parse import urlencode
 import time
+import random
+import re
+import threading
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from itertools import zip_longest
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, as_completed
 from datetime import datetime
+import numpy as np
+import pandas as pd
 from pymongo import MongoClient
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # ====================================
 # VERSION AND ENVIRONMENT
@@ -67,10 +85,18 @@ CLIENT_SECRET = st.secrets["SPOTIFY_CLIENT_SECRET"]
 OPENAI_API_KEY = st.secrets["OPENAI_API_KEY"]
 REDIRECT_URI = st.secrets.get("SPOTIFY_REDIRECT_URI", "http://localhost:8501/callback")
 
-# Spotify API endpoints
-SPOTIFY_AUTH_URL = "https://accounts.spotify.com/authorize"
-SPOTIFY_TOKEN_URL = "https://accounts.spotify.com/api/token"
-SPOTIFY_API_URL = "https://api.spotify.com/v1"
+# Spotify API endpoints (overridable in secrets, e.g. to point at local fakes for load testing)
+SPOTIFY_ACCOUNTS_URL = st.secrets.get("SPOTIFY_ACCOUNTS_URL", "https://accounts.spotify.com")
+SPOTIFY_AUTH_URL = f"{SPOTIFY_ACCOUNTS_URL}/authorize"
+SPOTIFY_TOKEN_URL = f"{SPOTIFY_ACCOUNTS_URL}/api/token"
+SPOTIFY_API_URL = st.secrets.get("SPOTIFY_API_URL", "https://api.spotify.com/v1")
+
+# LLM endpoints (None keeps the OpenAI SDK default)
+OPENAI_BASE_URL = st.secrets.get("OPENAI_BASE_URL")
+DEEPSEEK_API_URL = st.secrets.get("DEEPSEEK_API_URL", "https://api.deepseek.com/v1/chat/completions")
+# Seconds before an LLM request is abandoned, so a cancelled run doesn't keep
+# its thread busy for the OpenAI SDK's 10-minute default
+LLM_REQUEST_TIMEOUT = st.secrets.get("LLM_REQUEST_TIMEOUT", 60)
 
 # Required Spotify permissions for playlist creation and modification
 SCOPES = "playlist-modify-private playlist-modify-public"
@@ -78,13 +104,29 @@ SCOPES = "playlist-modify-private playlist-modify-public"
 # ====================================
 # CONFIGURATION MANAGEMENT
 # ====================================
+# Target Spotify audio features (0-1) per mood, matched by keyword against the
+# configured mood names. Can be overridden with a "mood_profiles" table in config.
+DEFAULT_MOOD_PROFILES = {
+    "happy": {"valence": 0.85, "energy": 0.70, "danceability": 0.70, "acousticness": 0.25},
+    "sad": {"valence": 0.20, "energy": 0.30, "danceability": 0.35, "acousticness": 0.60},
+    "energetic": {"valence": 0.65, "energy": 0.90, "danceability": 0.70, "acousticness": 0.10},
+    "relax": {"valence": 0.50, "energy": 0.30, "danceability": 0.45, "acousticness": 0.65},
+    "calm": {"valence": 0.50, "energy": 0.25, "danceability": 0.40, "acousticness": 0.70},
+    "romantic": {"valence": 0.60, "energy": 0.40, "danceability": 0.55, "acousticness": 0.50},
+    "focus": {"valence": 0.45, "energy": 0.40, "danceability": 0.45, "acousticness": 0.55},
+    "party": {"valence": 0.75, "energy": 0.85, "danceability": 0.85, "acousticness": 0.10},
+    "melancholic": {"valence": 0.25, "energy": 0.35, "danceability": 0.35, "acousticness": 0.55},
+    "angry": {"valence": 0.30, "energy": 0.90, "danceability": 0.50, "acousticness": 0.05}
+}
+
 def load_config():
     """
     Loads mood and genre options from Streamlit secrets.
-    Returns: Dictionary containing available moods, genres, and AI models
+    Returns: Dictionary containing available moods, genres, AI models and mood profiles
     """
     try:
-        config = st.secrets["config"]
+        # Copy so defaults can be added (secrets are read-only)
+        config = dict(st.secrets["config"])
         # Add default AI models if not present in config
         if "ai_models" not in config:
             config["ai_models"] = {
@@ -92,6 +134,8 @@ def load_config():
                 "gpt-4": "GPT-4",
                 "deepseek-chat": "DeepSeek Chat"
             }
+        if "mood_profiles" not in config:
+            config["mood_profiles"] = DEFAULT_MOOD_PROFILES
         return config
     except KeyError:
         st.error("❌ Configuration not found in Streamlit secrets.")
@@ -102,7 +146,8 @@ def load_config():
                 "gpt-3.5-turbo": "GPT-3.5 Turbo",
                 "gpt-4": "GPT-4",
                 "deepseek-chat": "DeepSeek Chat"
-            }
+            },
+            "mood_profiles": DEFAULT_MOOD_PROFILES
         }
 
 config = load_config()
@@ -113,10 +158,7 @@ def load_feature_flags():
     Controls: hidden gems, new music, debugging mode, underground music, band music
     """
     try:
-        feature_flags = st.secrets["feature_flags"]
-        if feature_flags.get("debugging", False):
-            st.write("🔍 Debug: Feature flags loaded:", feature_flags)
-        return feature_flags
+        return st.secrets["feature_flags"]
     except KeyError:
         st.error("❌ Feature flags not found in Streamlit secrets.")
         return {
@@ -129,34 +171,303 @@ def load_feature_flags():
 
 feature_flags = load_feature_flags()
 
+# ====================================
+# STRUCTURED LOGGING
+# ====================================
+# Diagnostics go to a bounded per-session ring buffer shown in the admin debug
+# panel instead of being written into the page for every user
+LOG_BUFFER_SIZE = feature_flags.get("log_buffer_size", 500)
+# Share of sessions that get debug-level diagnostics when "debugging" is off
+LOG_SAMPLE_RATE = feature_flags.get("log_sample_rate", 0.0)
+# Longer field values are truncated so records stay small
+LOG_MAX_FIELD_CHARS = 500
+LOG_LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR"]
+
+# Admin sessions are opened with ?admin=<ADMIN_KEY>
+ADMIN_KEY = st.secrets.get("ADMIN_KEY")
+
+logger = logging.getLogger("playlist_creator")
+
+def is_admin_session():
+    """
+    Checks the admin query parameter once per session and remembers it,
+    since the Spotify login redirect drops query parameters
+    """
+    if not st.session_state.get("is_admin") and ADMIN_KEY:
+        st.session_state.is_admin = st.query_params.get("admin") == ADMIN_KEY
+    return st.session_state.get("is_admin", False)
+
+def get_session_log_level():
+    """
+    Minimum level recorded for this session:
+    - DEBUG when the global "debugging" flag is on or the session was sampled
+    - WARNING otherwise (admins can change it from the debug panel)
+    """
+    if "log_level" not in st.session_state:
+        debug = feature_flags.get("debugging", False) or random.random() < LOG_SAMPLE_RATE
+        st.session_state.log_level = logging.DEBUG if debug else logging.WARNING
+    return st.session_state.log_level
+
+def get_session_log_buffer():
+    if "log_buffer" not in st.session_state:
+        st.session_state.log_buffer = deque(maxlen=LOG_BUFFER_SIZE)
+    return st.session_state.log_buffer
+
+def truncate_log_value(value):
+    if isinstance(value, (bool, int, float)) or value is None:
+        return value
+    text = str(value)
+    if len(text) > LOG_MAX_FIELD_CHARS:
+        return f"{text[:LOG_MAX_FIELD_CHARS]}... ({len(text)} chars)"
+    return text
+
+def log_event(level, event, **fields):
+    """
+    Records a structured event for the current session.
+    Events below the session level are dropped before any formatting;
+    warnings and errors are also sent to the server log.
+    """
+    if get_script_run_ctx(suppress_warning=True) is None:
+        # Worker threads without a session only reach the server log
+        logger.log(level, "%s %s", event, fields)
+        return
+    if level < get_session_log_level():
+        return
+    record = {
+        "time": datetime.now().strftime("%H:%M:%S.%f")[:-3],
+        "level": logging.getLevelName(level),
+        "event": event,
+        "fields": {key: truncate_log_value(value) for key, value in fields.items()}
+    }
+    get_session_log_buffer().append(record)
+    if level >= logging.WARNING:
+        logger.log(level, "%s %s", event, record["fields"])
+
+# Worker threads collect their user-facing errors here and the script thread
+# shows them, since Streamlit's page writes are not thread-safe
+_error_sink = threading.local()
+
+def report_error(message, code=None):
+    """
+    Shows an error (and an optional code preview) on the page, or collects it
+    when the current thread runs inside collect_errors()
+    """
+    errors = getattr(_error_sink, "errors", None)
+    if errors is not None:
+        errors.append((message, code))
+        return
+    st.error(message)
+    if code is not None:
+        st.code(code)
+
+@contextmanager
+def collect_errors():
+    """
+    Collects report_error() calls of the current thread instead of showing them
+    Yields: List of (message, code) tuples, to be passed to show_errors()
+    """
+    _error_sink.errors = []
+    try:
+        yield _error_sink.errors
+    finally:
+        _error_sink.errors = None
+
+def show_errors(errors):
+    for message, code in errors:
+        st.error(message)
+        if code is not None:
+            st.code(code)
+
+def display_debug_panel():
+    """
+    Admin-only view of this session's log buffer with a level selector
+    """
+    if not is_admin_session():
+        return
+    with st.expander("🔍 Debug log"):
+        current = logging.getLevelName(get_session_log_level())
+        level = st.selectbox("Log level", LOG_LEVELS, index=LOG_LEVELS.index(current), key="debug_log_level")
+        st.session_state.log_level = logging.getLevelName(level)
+        buffer = get_session_log_buffer()
+        if buffer:
+            records = pd.DataFrame(list(buffer))
+            records["fields"] = records["fields"].apply(json.dumps)
+            st.dataframe(records, width="stretch", hide_index=True)
+        else:
+            st.caption("No events recorded yet.")
+        if st.button("Clear log", key="clear_debug_log"):
+            buffer.clear()
+        st.markdown("**Model router**")
+        router_stats = get_model_router_stats()
+        with router_stats["lock"]:
+            rows = [
+                {
+                    "model": model,
+                    "mode": feature_mode,
+                    "runs": entry["runs"],
+                    "avg_latency": round(entry["latency_total"] / entry["runs"], 2),
+                    "repair_rate": round(entry["repaired"] / entry["runs"], 2),
+                    "resolution_rate": round(entry["songs_resolved"] / max(entry["songs_requested"], 1), 2),
+                    "score": round(score_model(entry), 3)
+                }
+                for (model, feature_mode), entry in router_stats["entries"].items() if entry["runs"]
+            ]
+        if rows:
+            st.dataframe(pd.DataFrame(rows), width="stretch", hide_index=True)
+        else:
+            st.caption("No model runs recorded yet.")
+
+log_event(logging.DEBUG, "feature_flags_loaded", flags=dict(feature_flags))
+
+# ====================================
+# MODEL ROUTING
+# ====================================
+# "auto" lets the router pick the model per feature mode based on what we
+# have measured so far instead of a static default
+AUTO_MODEL = "auto"
+# Share of requests routed to a random model so every model keeps getting data
+MODEL_ROUTER_EXPLORATION = feature_flags.get("model_router_exploration", 0.1)
+# Latency (seconds) at which a model's score is halved
+MODEL_ROUTER_LATENCY_REFERENCE = 10.0
+
+@st.cache_resource
+def get_model_router_stats():
+    """
+    Process-wide routing statistics shared by all sessions.
+    Keyed by (model, feature mode), each entry holds:
+    - runs: number of completed generations
+    - latency_total: summed LLM latency in seconds
+    - repaired: runs whose JSON needed cleanup
+    - songs_requested / songs_resolved: Spotify resolution counts
+    """
+    return {"lock": threading.Lock(), "entries": {}}
+
+def score_model(entry):
+    """
+    Scores a model for a feature mode (higher is better):
+    resolution rate, penalized by JSON repair rate and by average latency
+    """
+    runs = entry["runs"]
+    resolution_rate = entry["songs_resolved"] / max(entry["songs_requested"], 1)
+    repair_rate = entry["repaired"] / runs
+    avg_latency = entry["latency_total"] / runs
+    return resolution_rate * (1 - 0.5 * repair_rate) / (1 + avg_latency / MODEL_ROUTER_LATENCY_REFERENCE)
+
+def choose_model(models, feature_mode):
+    """
+    Picks the model to use for a feature mode:
+    - Models without data for this mode are tried first
+    - With probability MODEL_ROUTER_EXPLORATION a random model is used
+    - Otherwise the model with the best measured score
+    """
+    stats = get_model_router_stats()
+    with stats["lock"]:
+        entries = {model: stats["entries"].get((model, feature_mode)) for model in models}
+    untried = [model for model, entry in entries.items() if not entry or not entry["runs"]]
+    if untried:
+        return random.choice(untried)
+    if random.random() < MODEL_ROUTER_EXPLORATION:
+        return random.choice(models)
+    return max(models, key=lambda model: score_model(entries[model]))
+
+def record_model_outcome(model, feature_mode, run_stats, songs_requested, songs_resolved):
+    """
+    Records one generation run for the router:
+    LLM latency and JSON repair come from run_stats (filled by generate_playlist_details),
+    resolution counts from handle_playlist_creation
+    """
+    if "llm_latency" not in run_stats:
+        return
+    stats = get_model_router_stats()
+    with stats["lock"]:
+        entry = stats["entries"].setdefault((model, feature_mode), {
+            "runs": 0,
+            "latency_total": 0.0,
+            "repaired": 0,
+            "songs_requested": 0,
+            "songs_resolved": 0
+        })
+        entry["runs"] += 1
+        entry["latency_total"] += run_stats["llm_latency"]
+        entry["repaired"] += int(run_stats.get("json_repaired", False))
+        entry["songs_requested"] += songs_requested
+        entry["songs_resolved"] += songs_resolved
+        score = score_model(entry)
+    log_event(logging.INFO, "model_outcome", model=model, feature_mode=feature_mode,
+              llm_latency=round(run_stats["llm_latency"], 2), json_repaired=run_stats.get("json_repaired", False),
+              songs_requested=songs_requested, songs_resolved=songs_resolved, score=round(score, 3))
+
 # ====================================
 # PLAYLIST GENERATION
 # ====================================
-def build_system_content(hidden_gems, discover_new, songs_from_films, underground_music=False, band_name=None):
+def build_system_content(hidden_gems, discover_new, songs_from_films, underground_music=False, band_name=None, song_count=15, output="playlist"):
     """
     Builds the system prompt for ChatGPT with specific rules:
     - Playlist name max 4 words
     - Description max 20 words
-    - Exactly 15 songs
+    - Exactly song_count songs (15 by default)
     - Special handling for hidden gems, new music, films, and underground music
+    The output argument selects the requested JSON:
+    "playlist" (name, description and songs), "details" (name and description only)
+    or "songs" (songs only, used by sharded generation)
     """
     content = (
         "You are a music expert and DJ who curates playlists based on mood and genres. "
         "Your role is to create a playlist that effectively captures the desired mood using the selected music genres. "
-        "Generate a creative playlist name (max 4 words), a concise description (max 20 words), and exactly 15 songs. "
+    )
+    if output == "details":
+        content += (
+            "Generate a creative playlist name (max 4 words) and a concise description (max 20 words). Do not list songs. "
+            "IMPORTANT: Use only basic ASCII characters. No special quotes, apostrophes, or symbols. "
+            'RESPOND WITH ONLY THE FOLLOWING JSON STRUCTURE, NO OTHER TEXT: '
+            '{"name": "Simple Name", "description": "Simple description"}'
+        )
+        # Only the naming rules of each mode apply; their song rules would make the model list songs
+        if underground_music:
+            content += (
+                "The playlist name should evoke discovery and authenticity. "
+                "The description should emphasize the unfiltered creativity and artistic vision of underground musicians. "
+            )
+        if hidden_gems:
+            content += (
+                "The playlist name should contain words like 'Hidden', 'Undiscovered', or 'Rare'. "
+                "The description must emphasize the curated nature and uniqueness of lesser-known musical treasures. "
+            )
+        if discover_new:
+            content += (
+                "The playlist name should contain words like 'Fresh', 'New', or 'Rising'. "
+                "The description must emphasize discovering the latest music and emerging talent. "
+            )
+        if songs_from_films:
+            content += "The playlist name and description must highlight that it features unforgettable tracks from beloved films and series. "
+        if band_name:
+            content += (
+                f"The playlist is inspired by the musical style and legacy of '{band_name}'. "
+                "The playlist name should reference the band's signature sound or style. "
+                "The description should explain how the playlist connects to the band's musical legacy. "
+            )
+        return content
+
+    if output == "songs":
+        content += f"Generate exactly {song_count} songs. "
+        structure = '{"songs": ['
+    else:
+        content += f"Generate a creative playlist name (max 4 words), a concise description (max 20 words), and exactly {song_count} songs. "
+        structure = '{"name": "Simple Name", "description": "Simple description", "songs": ['
+    content += (
         "IMPORTANT: Use only basic ASCII characters. No special quotes, apostrophes, or symbols. "
         "Each song MUST include these exact fields with proper JSON formatting: "
         "title (string), artist (string), year (integer), is_hidden_gem (boolean), is_new_music (boolean), is_from_film (boolean). "
         'RESPOND WITH ONLY THE FOLLOWING JSON STRUCTURE, NO OTHER TEXT: '
-        '{"name": "Simple Name", "description": "Simple description", "songs": ['
+        + structure +
         '{"title": "Song Name", "artist": "Artist Name", "year": 2024, "is_hidden_gem": false, "is_new_music": false, "is_from_film": false}'
         ']}'
     )
 
-    # Ensure 15 songs requirement for all modes
+    # Ensure song count requirement for all modes
     content += (
-        "Ensure the playlist contains exactly 15 songs, even if the filters limit the selection. "
-        "If fewer than 15 songs are selected, fill the remaining slots with appropriate tracks from the same genres. "
+        f"Ensure the playlist contains exactly {song_count} songs, even if the filters limit the selection. "
+        f"If fewer than {song_count} songs are selected, fill the remaining slots with appropriate tracks from the same genres. "
     )
 
     if underground_music:
@@ -211,32 +522,36 @@ def build_system_content(hidden_gems, discover_new, songs_from_films, undergroun
         )
 
     if band_name:
+        content += f"Create a {song_count}-song playlist inspired by the musical style and legacy of '{band_name}'. "
+        if output == "playlist":
+            # The song mix; song shards get one part of it as their angle instead
+            content += (
+                f"- Include 3-5 essential songs from {band_name}: "
+                f"  • 2-3 of their most representative or iconic tracks "
+                f"  • 1-2 fan favorites or deep cuts that showcase their range "
+                f"- For the remaining 10-12 songs, create a diverse selection: "
+                f"  • 3-4 songs from artists with a very similar musical style "
+                f"  • 2-3 songs from artists who cite {band_name} as an influence "
+                f"  • 2-3 songs from artists from the same scene/era/genre "
+                f"  • 1-2 notable cover versions or tributes to {band_name} "
+                f"  • 2-3 songs that share similar themes, moods, or sonic elements "
+                f"  • 2-3 songs featuring collaborations between {band_name} and other artists "
+                f"  • 1-2 songs where members of {band_name} appear as featured artists "
+                f"- When selecting similar artists, consider: "
+                f"  • Artists who have toured or collaborated with {band_name} "
+                f"  • Musicians from the same geographic scene or movement "
+                f"  • Contemporary artists carrying forward their musical tradition "
+                f"  • Side projects or solo work from {band_name} members "
+                f"- If unable to find enough songs matching the above criteria, expand the search to: "
+                f"  • Additional songs from {band_name}'s discography, including live versions and remixes "
+                f"  • Songs from artists in related or adjacent genres "
+                f"  • Songs from artists who share band members or producers with {band_name} "
+                f"  • Songs that were popular during {band_name}'s peak era "
+                f"  • Songs that influenced {band_name}'s musical style "
+                f"  • Collaborative projects between {band_name} members and other musicians "
+            )
         content += (
-            f"Create a 15-song playlist inspired by the musical style and legacy of '{band_name}'. "
-            f"- Include 3-5 essential songs from {band_name}: "
-            f"  • 2-3 of their most representative or iconic tracks "
-            f"  • 1-2 fan favorites or deep cuts that showcase their range "
-            f"- For the remaining 10-12 songs, create a diverse selection: "
-            f"  • 3-4 songs from artists with a very similar musical style "
-            f"  • 2-3 songs from artists who cite {band_name} as an influence "
-            f"  • 2-3 songs from artists from the same scene/era/genre "
-            f"  • 1-2 notable cover versions or tributes to {band_name} "
-            f"  • 2-3 songs that share similar themes, moods, or sonic elements "
-            f"  • 2-3 songs featuring collaborations between {band_name} and other artists "
-            f"  • 1-2 songs where members of {band_name} appear as featured artists "
-            f"- When selecting similar artists, consider: "
-            f"  • Artists who have toured or collaborated with {band_name} "
-            f"  • Musicians from the same geographic scene or movement "
-            f"  • Contemporary artists carrying forward their musical tradition "
-            f"  • Side projects or solo work from {band_name} members "
-            f"- If unable to find enough songs matching the above criteria, expand the search to: "
-            f"  • Additional songs from {band_name}'s discography, including live versions and remixes "
-            f"  • Songs from artists in related or adjacent genres "
-            f"  • Songs from artists who share band members or producers with {band_name} "
-            f"  • Songs that were popular during {band_name}'s peak era "
-            f"  • Songs that influenced {band_name}'s musical style "
-            f"  • Collaborative projects between {band_name} members and other musicians "
-            "The playlist MUST contain exactly 15 songs - no more, no less. "
+            f"The playlist MUST contain exactly {song_count} songs - no more, no less. "
             "The playlist name should reference the band's signature sound or style. "
             "The description should explain how each song connects to the band's musical legacy. "
             "Mark songs by the main band with 'is_band_music': true. "
@@ -245,12 +560,13 @@ def build_system_content(hidden_gems, discover_new, songs_from_films, undergroun
 
     return content
 
-def build_user_content(mood, genres, hidden_gems, discover_new, songs_from_films, underground_music=False, band_name=None):
+def build_user_content(mood, genres, hidden_gems, discover_new, songs_from_films, underground_music=False, band_name=None, exclude_songs=None):
     """
     Creates the user prompt for ChatGPT combining:
     - Selected mood and genres (if not band mode)
     - Band focus (if band mode)
     - Feature-specific requirements
+    - Songs the listener already knows (exclude_songs, list of (title, artist))
     """
     # Set base content based on mode
     if band_name:
@@ -288,25 +604,25 @@ def build_user_content(mood, genres, hidden_gems, discover_new, songs_from_films
             "Avoid any commercially successful or mainstream tracks. "
         )
 
+    if exclude_songs:
+        known_songs = "; ".join(f"{title} - {artist}" for title, artist in exclude_songs)
+        user_content += f"Do not include these songs the listener already knows: {known_songs}. "
+
     # Always include year requirement
     user_content += "Ensure each song has an accurate release year as an integer."
 
     return user_content
 
-def generate_playlist_details(mood, genres, hidden_gems=False, discover_new=False, songs_from_films=False, underground_music=False, band_name=None, model="gpt-3.5-turbo"):
+def call_llm(model, system_content, user_content):
     """
-    Generates playlist details using selected AI model based on user preferences.
-    Returns: Tuple of (playlist_name, description, songs_list)
+    Sends one chat request to the selected AI model.
+    Makes no Streamlit calls, so it can run in worker threads.
+    Returns: Raw response text
     """
-    try:
-        if model.startswith("gpt"):
-            # Use OpenAI for GPT models
-            client = openai.OpenAI(api_key=OPENAI_API_KEY)
-            
-            # Build the system and user content for the prompt
-            system_content = build_system_content(hidden_gems, discover_new, songs_from_films, underground_music, band_name)
-            user_content = build_user_content(mood, genres, hidden_gems, discover_new, songs_from_films, underground_music, band_name)
-            
+    if model.startswith("gpt"):
+        # Use OpenAI for GPT models; the client is closed with its connections after the call.
+        # No SDK retries, so the timeout bounds the whole call like the DeepSeek request.
+        with openai.OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL, timeout=LLM_REQUEST_TIMEOUT, max_retries=0) as client:
             # Make the API call to GPT
             response = client.chat.completions.create(
                 model=model,
@@ -316,86 +632,105 @@ def generate_playlist_details(mood, genres, hidden_gems=False, discover_new=Fals
                 ],
                 temperature=0.7
             )
-            
-            # Get the response content
-            raw_response = response.choices[0].message.content
-            
-        elif model == "deepseek-chat":
-            # Use DeepSeek API
-            DEEPSEEK_API_KEY = st.secrets["DEEPSEEK_API_KEY"]
-            DEEPSEEK_API_URL = "https://api.deepseek.com/v1/chat/completions"
-            
-            # Build the system and user content for the prompt
-            system_content = build_system_content(hidden_gems, discover_new, songs_from_films, underground_music, band_name)
-            user_content = build_user_content(mood, genres, hidden_gems, discover_new, songs_from_films, underground_music, band_name)
-            
-            # Make the API call to DeepSeek
-            response = requests.post(
-                DEEPSEEK_API_URL,
-                headers={
-                    "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "model": "deepseek-chat",
-                    "messages": [
-                        {"role": "system", "content": system_content},
-                        {"role": "user", "content": user_content}
-                    ],
-                    "temperature": 0.7
-                }
-            )
-            
-            if response.status_code != 200:
-                raise Exception(f"DeepSeek API error: {response.text}")
-            
-            # Get the response content
-            raw_response = response.json()["choices"][0]["message"]["content"]
         
-        else:
-            raise ValueError(f"Unsupported model: {model}")
+        # Get the response content
+        return response.choices[0].message.content
+        
+    elif model == "deepseek-chat":
+        # Use DeepSeek API
+        DEEPSEEK_API_KEY = st.secrets["DEEPSEEK_API_KEY"]
+        
+        # Make the API call to DeepSeek
+        response = requests.post(
+            DEEPSEEK_API_URL,
+            headers={
+                "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
+                "Content-Type": "application/json"
+            },
+            json={
+                "model": "deepseek-chat",
+                "messages": [
+                    {"role": "system", "content": system_content},
+                    {"role": "user", "content": user_content}
+                ],
+                "temperature": 0.7
+            },
+            timeout=LLM_REQUEST_TIMEOUT
+        )
+        
+        if response.status_code != 200:
+            raise Exception(f"DeepSeek API error: {response.text}")
+        
+        # Get the response content
+        return response.json()["choices"][0]["message"]["content"]
+    
+    else:
+        raise ValueError(f"Unsupported model: {model}")
+
+def generate_playlist_details(mood, genres, hidden_gems=False, discover_new=False, songs_from_films=False, underground_music=False, band_name=None, model="gpt-3.5-turbo", run_stats=None, exclude_songs=None):
+    """
+    Generates playlist details using selected AI model based on user preferences.
+    If run_stats is given, it is filled with the LLM latency and whether the JSON needed repair.
+    Returns: Tuple of (playlist_name, description, songs_list)
+    """
+    try:
+        llm_start = time.time()
+        
+        # Build the system and user content for the prompt
+        system_content = build_system_content(hidden_gems, discover_new, songs_from_films, underground_music, band_name)
+        user_content = build_user_content(mood, genres, hidden_gems, discover_new, songs_from_films, underground_music, band_name, exclude_songs)
+        raw_response = call_llm(model, system_content, user_content)
+        
+        if run_stats is not None:
+            run_stats["llm_latency"] = time.time() - llm_start
         
         # Process and validate the response
-        if feature_flags.get("debugging", False):
-            st.write(f"🔍 Debug: Raw {model} Response:", raw_response)
+        log_event(logging.DEBUG, "llm_response", model=model, raw_response=raw_response)
         
         # Clean and validate the JSON response
-        name, description, songs = validate_and_clean_json(raw_response)
+        name, description, songs = validate_and_clean_json(raw_response, run_stats)
         
         return name, description, songs
         
     except Exception as e:
-        st.error(f"❌ Error generating playlist with {model}: {str(e)}")
-        if feature_flags.get("debugging", False):
-            st.write("🔍 Debug: Error details:", str(e))
+        if run_stats is not None:
+            run_stats.setdefault("llm_latency", time.time() - llm_start)
+        report_error(f"❌ Error generating playlist with {model}: {str(e)}")
+        log_event(logging.ERROR, "llm_error", model=model, error=str(e))
         return None, None, None
 
 # ====================================
 # JSON PROCESSING
 # ====================================
-def validate_and_clean_json(raw_response):
+def validate_and_clean_json(raw_response, run_stats=None):
     """
     Processes ChatGPT's response:
     1. Validates JSON format
     2. Cleans special characters
     3. Ensures required fields exist
     4. Handles error cases
+    Marks run_stats["json_repaired"] when cleanup was needed
+    """
+    playlist_data = parse_llm_json(raw_response, run_stats)
+    validate_playlist_data(playlist_data)
+    return playlist_data["name"], playlist_data["description"], playlist_data["songs"]
+
+def parse_llm_json(raw_response, run_stats=None):
+    """
+    Parses the model's JSON, falling back to cleanup.
+    Marks run_stats["json_repaired"] when cleanup was needed
     """
     if not raw_response:
         raise ValueError("ChatGPT response is empty.")
     
-    if feature_flags.get("debugging", False):
-        st.write("🔍 Debug: Processing raw response...")
-    
     try:
-        playlist_data = json.loads(raw_response)
-        if feature_flags.get("debugging", False):
-            st.write("✅ Initial JSON parsing successful")
+        data = json.loads(raw_response)
+        log_event(logging.DEBUG, "json_parsed")
+        return data
     except json.JSONDecodeError:
-        playlist_data = attempt_json_cleanup(raw_response)
-    
-    validate_playlist_data(playlist_data)
-    return playlist_data["name"], playlist_data["description"], playlist_data["songs"]
+        if run_stats is not None:
+            run_stats["json_repaired"] = True
+        return attempt_json_cleanup(raw_response)
 
 def attempt_json_cleanup(raw_response):
     """
@@ -404,19 +739,14 @@ def attempt_json_cleanup(raw_response):
     - Fixes quote characters
     - Removes extra whitespace
     """
-    if feature_flags.get("debugging", False):
-        st.write("⚠️ Initial JSON parsing failed, attempting cleanup...")
     cleaned_response = clean_response(raw_response)
-    if feature_flags.get("debugging", False):
-        st.write("🔍 Cleaned response preview (first 200 chars):")
-        st.code(cleaned_response[:200])
+    log_event(logging.INFO, "json_cleanup", preview=cleaned_response[:200])
     
     try:
         return json.loads(cleaned_response)
     except json.JSONDecodeError as e:
-        st.error(f"❌ JSON Error Details:\nPosition: {e.pos}\nLine: {e.lineno}\nColumn: {e.colno}")
-        st.error("❌ Raw Response Preview:")
-        st.code(raw_response[:200])
+        report_error(f"❌ JSON Error Details:\nPosition: {e.pos}\nLine: {e.lineno}\nColumn: {e.colno}")
+        report_error("❌ Raw Response Preview:", raw_response[:200])
         raise ValueError(f"Could not process JSON even after cleaning. Error: {str(e)}")
 
 def clean_response(raw_response):
@@ -435,9 +765,15 @@ def validate_playlist_data(playlist_data):
     required_keys = {"name", "description", "songs"}
     if not required_keys.issubset(playlist_data):
         raise ValueError(f"JSON does not contain expected keys {required_keys}.")
-    if not isinstance(playlist_data["songs"], list):
+    validate_songs(playlist_data["songs"])
+
+def validate_songs(songs):
+    """
+    Validates the song list and sets default values
+    """
+    if not isinstance(songs, list):
         raise ValueError("The 'songs' field is not a list.")
-    for song in playlist_data["songs"]:
+    for song in songs:
         if not all(key in song for key in ["title", "artist", "year"]):
             raise ValueError("Songs do not contain required fields ('title', 'artist', 'year').")
         if not isinstance(song.get('year', 0), int):
@@ -449,6 +785,133 @@ def validate_playlist_data(playlist_data):
         song.setdefault('is_underground', False)
         song.setdefault('is_band_music', False)
 
+# ====================================
+# SHARDED GENERATION
+# ====================================
+# Instead of one long completion, the name/description and several short song
+# lists are requested at once, so generation time follows the slowest short call.
+# Each shard asks for one extra song to absorb duplicates across shards.
+SHARD_COUNT = max(1, int(feature_flags.get("sharded_generation_shards", 3)))
+SHARD_TARGET_SONGS = 15
+
+GENERIC_SHARD_ANGLES = [
+    "well-known tracks that define the mood",
+    "album tracks and deeper cuts from established artists",
+    "lesser-known and recent artists",
+    "songs from adjacent genres that still fit the mood",
+]
+
+def get_shard_angles(band_name=None):
+    """
+    Returns: One distinct sub-angle per shard
+    """
+    if band_name:
+        angles = [
+            f"essential songs from {band_name}: iconic tracks, fan favorites and deep cuts",
+            f"artists with a similar style, from the same scene, or influenced by {band_name}",
+            f"covers, collaborations, side projects and songs sharing {band_name}'s themes",
+        ]
+    else:
+        angles = GENERIC_SHARD_ANGLES
+    return [angles[i % len(angles)] for i in range(SHARD_COUNT)]
+
+def build_shard_content(system_content, angle, other_angles):
+    """
+    Narrows the system prompt to one shard and excludes the other shards' angles
+    """
+    content = system_content + (
+        f"This request covers only part of the playlist. Focus only on {angle}. "
+    )
+    if other_angles:
+        content += (
+            f"Other parts of the playlist cover {'; '.join(other_angles)}. "
+            "Do not pick songs that belong to those parts. "
+        )
+    return content
+
+def merge_shard_songs(shards, limit):
+    """
+    Interleaves the shards' songs round-robin so every angle is represented,
+    dropping duplicates by normalized title and artist
+    Returns: At most limit songs
+    """
+    merged, seen = [], set()
+    for row in zip_longest(*shards):
+        for song in row:
+            if song is None:
+                continue
+            key = (normalize_track_key(song["title"]), normalize_track_key(song["artist"]))
+            if key not in seen:
+                seen.add(key)
+                merged.append(song)
+    return merged[:limit]
+
+def generate_playlist_details_sharded(mood, genres, hidden_gems=False, discover_new=False, songs_from_films=False, underground_music=False, band_name=None, model="gpt-3.5-turbo", run_stats=None, exclude_songs=None):
+    """
+    Sharded version of generate_playlist_details with the same arguments and result.
+    The details request must succeed; failed song shards are tolerated as long as one succeeds.
+    Returns: Tuple of (playlist_name, description, songs_list)
+    """
+    llm_start = time.time()
+    features = (hidden_gems, discover_new, songs_from_films, underground_music, band_name)
+    songs_per_shard = -(-SHARD_TARGET_SONGS // SHARD_COUNT) + 1
+    user_content = build_user_content(mood, genres, *features, exclude_songs)
+    angles = get_shard_angles(band_name)
+    songs_content = build_system_content(*features, song_count=songs_per_shard, output="songs")
+
+    executor = ThreadPoolExecutor(max_workers=SHARD_COUNT + 1)
+    try:
+        details_future = executor.submit(call_llm, model, build_system_content(*features, output="details"), user_content)
+        shard_futures = [
+            executor.submit(call_llm, model, build_shard_content(songs_content, angle, angles[:i] + angles[i + 1:]), user_content)
+            for i, angle in enumerate(angles)
+        ]
+
+        # Parse each song shard; a bad shard only costs its songs
+        shards = []
+        for i, future in enumerate(shard_futures):
+            try:
+                raw_response = future.result()
+                log_event(logging.DEBUG, "llm_response", model=model, shard=i, raw_response=raw_response)
+                data = parse_llm_json(raw_response, run_stats)
+                if not isinstance(data, dict) or "songs" not in data:
+                    raise ValueError("JSON does not contain expected key 'songs'.")
+                validate_songs(data["songs"])
+                shards.append(data["songs"])
+            except Exception as e:
+                log_event(logging.WARNING, "llm_shard_error", model=model, shard=i, error=str(e))
+
+        raw_response = details_future.result()
+        if run_stats is not None:
+            run_stats["llm_latency"] = time.time() - llm_start
+        log_event(logging.DEBUG, "llm_response", model=model, shard="details", raw_response=raw_response)
+        details = parse_llm_json(raw_response, run_stats)
+        if not isinstance(details, dict) or not {"name", "description"}.issubset(details):
+            raise ValueError("JSON does not contain expected keys {'name', 'description'}.")
+        if not shards:
+            raise ValueError("All song shards failed.")
+
+        songs = merge_shard_songs(shards, SHARD_TARGET_SONGS)
+        log_event(logging.INFO, "sharded_generation", model=model, shards_ok=len(shards), shards=SHARD_COUNT, songs=len(songs))
+        return details["name"], details["description"], songs
+
+    except Exception as e:
+        if run_stats is not None:
+            run_stats.setdefault("llm_latency", time.time() - llm_start)
+        report_error(f"❌ Error generating playlist with {model}: {str(e)}")
+        log_event(logging.ERROR, "llm_error", model=model, error=str(e))
+        return None, None, None
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def get_playlist_generator():
+    """
+    Returns: The sharded generator when the sharded_generation flag is on, else the single-call one
+    """
+    if feature_flags.get("sharded_generation", False):
+        return generate_playlist_details_sharded
+    return generate_playlist_details
+
 # ====================================
 # SPOTIFY INTEGRATION
 # ====================================
@@ -482,7 +945,7 @@ def search_tracks(token, title, artist, year):
     """
     # Construct a more precise query with title, artist, and year
     query = f"track:{title} artist:{artist} year:{year}"
-    url = "https://api.spotify.com/v1/search"
+    url = f"{SPOTIFY_API_URL}/search"
     headers = {"Authorization": f"Bearer {token}"}
     params = {
         "q": query,
@@ -497,16 +960,22 @@ def search_tracks(token, title, artist, year):
         return {"tracks": {"items": []}}
     
     try:
-        if feature_flags.get("debugging", False):
-            st.write("🔍 Debug: Response content:", response.content)
-        return response.json()
+        results = response.json()
+        log_event(
+            logging.DEBUG,
+            "spotify_search",
+            query=query,
+            response_bytes=len(response.content),
+            items=len(results.get("tracks", {}).get("items", []))
+        )
+        return results
     except json.JSONDecodeError:
-        st.error("❌ Error decoding JSON response from Spotify.")
+        report_error("❌ Error decoding JSON response from Spotify.")
         return {"tracks": {"items": []}}
 
 def handle_spotify_error(response):
     error_message = response.json().get('error', {}).get('message', 'Unknown error')
-    st.error(f"❌ Error searching for songs: {error_message}")
+    report_error(f"❌ Error searching for songs: {error_message}")
 
 def create_playlist(token, user_id, name, description):
     """
@@ -533,11 +1002,11 @@ def create_playlist(token, user_id, name, description):
     try:
         response = requests.post(url, headers=headers, json=data)
         if response.status_code != 201:
-            st.error(f"❌ Error creating playlist: {response.json().get('error', {}).get('message', 'Unknown error')}")
+            report_error(f"❌ Error creating playlist: {response.json().get('error', {}).get('message', 'Unknown error')}")
             return {}
         return response.json()
     except Exception as e:
-        st.error(f"❌ Error creating playlist: {str(e)}")
+        report_error(f"❌ Error creating playlist: {str(e)}")
         return {}
 
 def add_tracks_to_playlist(token, playlist_id, track_uris):
@@ -558,9 +1027,687 @@ def add_tracks_to_playlist(token, playlist_id, track_uris):
     try:
         response = requests.post(url, headers=headers, json=data)
         if response.status_code != 201:
-            st.error(f"❌ Error adding tracks: {response.json().get('error', {}).get('message', 'Unknown error')}")
+            report_error(f"❌ Error adding tracks: {response.json().get('error', {}).get('message', 'Unknown error')}")
     except Exception as e:
-        st.error(f"❌ Error adding tracks: {str(e)}")
+        report_error(f"❌ Error adding tracks: {str(e)}")
+
+def create_playlist_with_tracks(token, user_id, name, description, track_uris):
+    """
+    Creates a new playlist and adds the tracks to it
+    Returns: Playlist ID, or None if the playlist could not be created
+    """
+    playlist_id = create_playlist(token, user_id, name, description).get("id")
+    if playlist_id:
+        add_tracks_to_playlist(token, playlist_id, track_uris)
+    return playlist_id
+
+# ====================================
+# BAND PREFETCH
+# ====================================
+# In band mode the artist's catalog is fetched while the LLM is generating,
+# so the band's own songs resolve from a local lookup instead of searches
+BAND_PREFETCH_WORKERS = 4
+# Related artists whose top tracks are also prefetched
+BAND_RELATED_ARTISTS = 5
+# Spotify accepts at most 20 IDs per albums request
+ALBUMS_BATCH_SIZE = 20
+# Longest time to wait for the prefetch once the LLM has answered
+BAND_PREFETCH_TIMEOUT = 5.0
+# Rate-limited (429) background requests are retried this often, waiting
+# Retry-After seconds (or an exponential backoff) but never longer than the cap
+SPOTIFY_MAX_RETRIES = 3
+SPOTIFY_MAX_RETRY_WAIT = 10.0
+
+def normalize_track_key(text):
+    """
+    Normalizes a title or artist for lookup: lowercase, without bracketed
+    suffixes like "(Remastered 2009)" or "- Live", and without punctuation
+    """
+    text = re.sub(r"\(.*?\)|\[.*?\]", "", str(text).lower())
+    text = text.split(" - ")[0]
+    return re.sub(r"[^a-z0-9]+", "", text)
+
+def spotify_request(token, path, params=None):
+    """
+    GET request to the Spotify Web API for background work,
+    backing off and retrying when rate limited
+    Returns: The final response (errors are logged), or None if the request failed
+    """
+    for attempt in range(SPOTIFY_MAX_RETRIES + 1):
+        try:
+            response = requests.get(f"{SPOTIFY_API_URL}{path}", headers={"Authorization": f"Bearer {token}"}, params=params, timeout=10)
+        except requests.RequestException as e:
+            log_event(logging.WARNING, "spotify_prefetch_error", path=path, error=str(e))
+            return None
+        if response.status_code == 200:
+            return response
+        if response.status_code != 429 or attempt == SPOTIFY_MAX_RETRIES:
+            break
+        try:
+            wait = float(response.headers.get("Retry-After", 2 ** attempt))
+        except ValueError:
+            wait = 2 ** attempt
+        log_event(logging.INFO, "spotify_rate_limited", path=path, wait=wait)
+        time.sleep(min(wait, SPOTIFY_MAX_RETRY_WAIT))
+    log_event(logging.WARNING, "spotify_prefetch_error", path=path, status=response.status_code)
+    return response
+
+def spotify_get(token, path, params=None):
+    """
+    GET request to the Spotify Web API for background work (see spotify_request)
+    Returns: Parsed JSON, or None on error
+    """
+    response = spotify_request(token, path, params)
+    return response.json() if response is not None and response.status_code == 200 else None
+
+def add_tracks_to_lookup(lookup, tracks):
+    for track in tracks:
+        if not track or not track.get("uri"):
+            continue
+        title = normalize_track_key(track["name"])
+        for artist in track.get("artists", []):
+            lookup.setdefault((title, normalize_track_key(artist["name"])), track["uri"])
+
+def fetch_band_catalog(token, band_name):
+    """
+    Builds a (title, artist) -> URI lookup for a band:
+    1. Resolves the artist
+    2. Fetches top tracks, albums and related artists concurrently
+    3. Fetches the album track lists and related artists' top tracks concurrently
+    Runs without Streamlit calls so it can overlap with the LLM request.
+    Returns: Lookup dictionary (empty if the artist is not found)
+    """
+    lookup = {}
+    search = spotify_get(token, "/search", {"q": band_name, "type": "artist", "limit": 1})
+    artists = (search or {}).get("artists", {}).get("items", [])
+    if not artists:
+        return lookup
+    artist_id = artists[0]["id"]
+
+    with ThreadPoolExecutor(max_workers=BAND_PREFETCH_WORKERS) as executor:
+        top_tracks = executor.submit(spotify_get, token, f"/artists/{artist_id}/top-tracks", {"market": "US"})
+        albums = executor.submit(spotify_get, token, f"/artists/{artist_id}/albums", {"include_groups": "album,single", "market": "US", "limit": 50})
+        related = executor.submit(spotify_get, token, f"/artists/{artist_id}/related-artists")
+
+        album_ids = [album["id"] for album in (albums.result() or {}).get("items", [])]
+        album_pages = [
+            executor.submit(spotify_get, token, "/albums", {"ids": ",".join(album_ids[start:start + ALBUMS_BATCH_SIZE]), "market": "US"})
+            for start in range(0, len(album_ids), ALBUMS_BATCH_SIZE)
+        ]
+        related_ids = [artist["id"] for artist in (related.result() or {}).get("artists", [])[:BAND_RELATED_ARTISTS]]
+        related_top_tracks = [
+            executor.submit(spotify_get, token, f"/artists/{related_id}/top-tracks", {"market": "US"})
+            for related_id in related_ids
+        ]
+
+        add_tracks_to_lookup(lookup, (top_tracks.result() or {}).get("tracks", []))
+        for page in album_pages:
+            for album in (page.result() or {}).get("albums", []):
+                if album:
+                    add_tracks_to_lookup(lookup, album.get("tracks", {}).get("items", []))
+        for future in related_top_tracks:
+            add_tracks_to_lookup(lookup, (future.result() or {}).get("tracks", []))
+    return lookup
+
+def start_band_prefetch(token, band_name):
+    """
+    Starts fetch_band_catalog in the background
+    Returns: Future resolving to the lookup dictionary
+    """
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(fetch_band_catalog, token, band_name)
+    executor.shutdown(wait=False)
+    return future
+
+def collect_band_prefetch(future):
+    """
+    Waits briefly for the prefetch started alongside the LLM request
+    Returns: Lookup dictionary (empty if the prefetch failed or is too slow)
+    """
+    try:
+        lookup = future.result(timeout=BAND_PREFETCH_TIMEOUT)
+    except Exception as e:
+        log_event(logging.WARNING, "band_prefetch_failed", error=str(e))
+        return {}
+    log_event(logging.DEBUG, "band_prefetch", tracks=len(lookup))
+    return lookup
+
+# ====================================
+# USER LIBRARY INDEX
+# ====================================
+# Discovery modes skip tracks the user already has saved or in their playlists
+DISCOVERY_FEATURES = ["💎 Hidden Gems", "🆕 New Music", "🎸 Underground Music"]
+LIBRARY_SCOPES = "user-library-read playlist-read-private"
+if feature_flags.get("library_exclusion", False):
+    SCOPES = f"{SCOPES} {LIBRARY_SCOPES}"
+# Seconds before an index is refreshed in the background, and before a failed
+# refresh is retried
+LIBRARY_REFRESH_INTERVAL = 600
+LIBRARY_RETRY_INTERVAL = 60
+# Indexes unused for this many seconds are dropped, and at most this many are kept
+LIBRARY_INDEX_TTL = 3600
+LIBRARY_INDEX_MAX_USERS = 500
+LIBRARY_FETCH_WORKERS = 4
+# Library page requests in flight at once across all users
+LIBRARY_MAX_IN_FLIGHT = 16
+# Recently saved songs named in the prompt (the rest are filtered after resolution)
+LIBRARY_PROMPT_EXCLUSIONS = 30
+
+@st.cache_resource
+def get_library_indexes():
+    """
+    Process-wide library indexes keyed by Spotify user ID, least recently used
+    first. Each index holds:
+    - saved / saved_total: saved track IDs and their count (-1 if incomplete)
+    - playlists: playlist ID -> (snapshot_id, frozenset of track IDs)
+    - recent: (title, artist) of the most recently saved songs
+    - expires_at / used_at / refreshing: refresh and eviction bookkeeping
+    Track IDs are interned, so a track in several collections is stored once.
+    """
+    return {"lock": threading.Lock(), "users": OrderedDict()}
+
+@st.cache_resource
+def get_library_fetch_budget():
+    """
+    Process-wide cap on library page requests in flight
+    """
+    return threading.BoundedSemaphore(LIBRARY_MAX_IN_FLIGHT)
+
+def library_get(token, path, params=None):
+    with get_library_fetch_budget():
+        return spotify_get(token, path, params)
+
+def get_spotify_user_id(token):
+    """
+    Spotify user ID of the logged-in account, cached for the session
+    """
+    if "spotify_user_id" not in st.session_state:
+        profile = spotify_get(token, "/me")
+        if not profile:
+            return None
+        st.session_state.spotify_user_id = profile["id"]
+    return st.session_state.spotify_user_id
+
+def fetch_collections(executor, token, paths, page_size, params=None):
+    """
+    Fetches every item of several paginated collections concurrently:
+    first pages for all paths, then the remaining offsets, with requests
+    queued on the executor and capped by the process-wide fetch budget
+    Returns: Dictionary of path -> (item list, complete flag), or None if the
+    first page failed
+    """
+    params = params or {}
+    first_pages = {
+        path: executor.submit(library_get, token, path, {**params, "limit": page_size, "offset": 0})
+        for path in paths
+    }
+    remaining_pages = {}
+    for path, future in first_pages.items():
+        first_pages[path] = future.result()
+        if first_pages[path] is not None:
+            remaining_pages[path] = [
+                executor.submit(library_get, token, path, {**params, "limit": page_size, "offset": offset})
+                for offset in range(page_size, first_pages[path].get("total", 0), page_size)
+            ]
+    results = {}
+    for path in paths:
+        if first_pages[path] is None:
+            results[path] = None
+            continue
+        fetched = [first_pages[path]] + [future.result() for future in remaining_pages[path]]
+        items = [item for page in fetched if page is not None for item in page.get("items", [])]
+        results[path] = (items, all(page is not None for page in fetched))
+    return results
+
+def track_ids_of(items):
+    return frozenset(sys.intern(item["track"]["id"]) for item in items if item.get("track") and item["track"].get("id"))
+
+def build_library_index(token, previous=None):
+    """
+    Builds a user's library index, reusing the previous one where possible:
+    - Saved tracks are refetched only if the count or newest page changed
+    - Playlists are refetched only if their snapshot_id changed
+    If some saved-track pages fail, the tracks that did load are kept and the
+    next refresh refetches them. Playlists that fail keep their previous contents.
+    Runs without Streamlit calls so it can refresh in the background.
+    Returns: New index, or None if Spotify could not be read
+    """
+    previous = previous or {"saved": frozenset(), "saved_total": -1, "playlists": {}, "recent": []}
+    saved_total = previous["saved_total"]
+    with ThreadPoolExecutor(max_workers=LIBRARY_FETCH_WORKERS) as executor:
+        newest = library_get(token, "/me/tracks", {"limit": 50, "offset": 0})
+        playlists = fetch_collections(executor, token, ["/me/playlists"], 50)["/me/playlists"]
+        if newest is None or playlists is None or not playlists[1]:
+            return None
+        playlists = playlists[0]
+
+        saved, recent = previous["saved"], previous["recent"]
+        newest_ids = track_ids_of(newest.get("items", []))
+        if newest.get("total", 0) != previous["saved_total"] or not newest_ids <= saved:
+            saved_items = fetch_collections(executor, token, ["/me/tracks"], 50)["/me/tracks"]
+            if saved_items is None:
+                return None
+            saved = track_ids_of(saved_items[0])
+            saved_total = newest.get("total", 0) if saved_items[1] else -1
+            recent = [
+                (item["track"]["name"], item["track"]["artists"][0]["name"])
+                for item in newest.get("items", [])[:LIBRARY_PROMPT_EXCLUSIONS]
+                if item.get("track") and item["track"].get("artists")
+            ]
+
+        snapshots = {playlist["id"]: playlist["snapshot_id"] for playlist in playlists if playlist}
+        changed = [
+            playlist_id for playlist_id, snapshot_id in snapshots.items()
+            if previous["playlists"].get(playlist_id, (None,))[0] != snapshot_id
+        ]
+        fetched = fetch_collections(
+            executor, token, [f"/playlists/{playlist_id}/tracks" for playlist_id in changed], 100,
+            {"fields": "items(track(id)),total"}
+        )
+
+    playlist_tracks = {}
+    for playlist_id, snapshot_id in snapshots.items():
+        items = fetched.get(f"/playlists/{playlist_id}/tracks")
+        if playlist_id in changed and items is not None and items[1]:
+            playlist_tracks[playlist_id] = (snapshot_id, track_ids_of(items[0]))
+        elif playlist_id in previous["playlists"]:
+            # Unchanged, or failed this time: keep the previous contents
+            playlist_tracks[playlist_id] = previous["playlists"][playlist_id]
+
+    return {
+        "saved": saved,
+        "saved_total": saved_total,
+        "playlists": playlist_tracks,
+        "recent": recent,
+        "expires_at": time.time() + LIBRARY_REFRESH_INTERVAL,
+        "refreshing": False
+    }
+
+def refresh_library_index(token, user_key, indexes):
+    with indexes["lock"]:
+        previous = indexes["users"].get(user_key)
+    try:
+        index = build_library_index(token, previous if previous and "saved" in previous else None)
+    except Exception as e:
+        index = None
+        log_event(logging.WARNING, "library_index_error", error=str(e))
+    with indexes["lock"]:
+        used_at = (indexes["users"].get(user_key) or {}).get("used_at", time.time())
+        if index:
+            indexes["users"][user_key] = {**index, "used_at": used_at}
+        else:
+            # Keep the previous index and retry soon
+            indexes["users"][user_key] = {
+                **(previous or {}), "used_at": used_at, "refreshing": False,
+                "expires_at": time.time() + LIBRARY_RETRY_INTERVAL
+            }
+    log_event(
+        logging.INFO, "library_index_refreshed",
+        saved=len(index["saved"]) if index else None,
+        playlists=len(index["playlists"]) if index else None
+    )
+
+def evict_library_indexes(indexes, now):
+    """
+    Drops indexes unused for LIBRARY_INDEX_TTL seconds, then the least recently
+    used ones beyond LIBRARY_INDEX_MAX_USERS. Call with the lock held.
+    """
+    users = indexes["users"]
+    for user_key in [key for key, index in users.items() if now - index.get("used_at", now) > LIBRARY_INDEX_TTL]:
+        del users[user_key]
+    while len(users) > LIBRARY_INDEX_MAX_USERS:
+        users.popitem(last=False)
+
+def library_exclusions(index, skip_playlist_ids=()):
+    """
+    Track IDs to leave out of a new playlist: saved tracks plus the tracks of
+    every playlist except skip_playlist_ids
+    """
+    return index["saved"].union(*(
+        track_ids for playlist_id, (_, track_ids) in index["playlists"].items()
+        if playlist_id not in skip_playlist_ids
+    ))
+
+def ensure_library_index(token):
+    """
+    Returns the user's current library index (None until the first build finishes)
+    and starts a background refresh when it is missing or stale
+    """
+    user_key = get_spotify_user_id(token)
+    if not user_key:
+        return None
+    indexes = get_library_indexes()
+    now = time.time()
+    with indexes["lock"]:
+        evict_library_indexes(indexes, now)
+        index = indexes["users"].get(user_key)
+        if index:
+            index["used_at"] = now
+            indexes["users"].move_to_end(user_key)
+        stale = not index or now > index.get("expires_at", 0)
+        if stale and not (index and index.get("refreshing")):
+            indexes["users"][user_key] = {**(index or {}), "used_at": now, "refreshing": True}
+            threading.Thread(target=refresh_library_index, args=(token, user_key, indexes), daemon=True).start()
+    return index if index and "saved" in index else None
+
+# ====================================
+# MOOD FIT SCORING
+# ====================================
+# Spotify accepts at most 100 IDs per audio-features request
+AUDIO_FEATURES_BATCH_SIZE = 100
+MOOD_FEATURES = ["valence", "energy", "danceability", "acousticness"]
+# Tracks below this fit (0-1) or far below the playlist average are removed
+MOOD_FIT_MIN = 0.6
+MOOD_FIT_MAX_Z = 2.0
+# Never filter a playlist below this many tracks
+MOOD_FIT_MIN_TRACKS = 10
+# Tracks kept in the audio feature cache; the least recently used are evicted
+AUDIO_FEATURE_CACHE_SIZE = 20000
+
+@st.cache_resource
+def get_audio_feature_cache():
+    """
+    Process-wide LRU cache of audio feature vectors per track ID
+    (None for tracks Spotify has no features for).
+    restricted is set once Spotify answers 403, as it does for apps
+    registered after the endpoint was restricted.
+    """
+    return {"lock": threading.Lock(), "features": OrderedDict(), "restricted": False}
+
+def fetch_audio_features(token, track_ids):
+    """
+    Fetches mood features for the given tracks in batches of 100,
+    only requesting tracks that are not cached yet.
+    A failed request leaves its tracks without features.
+    Returns: Dictionary of track ID -> feature list (or None)
+    """
+    cache = get_audio_feature_cache()
+    with cache["lock"]:
+        if cache["restricted"]:
+            return {track_id: None for track_id in track_ids}
+        missing = [track_id for track_id in dict.fromkeys(track_ids) if track_id not in cache["features"]]
+
+    for start in range(0, len(missing), AUDIO_FEATURES_BATCH_SIZE):
+        batch = missing[start:start + AUDIO_FEATURES_BATCH_SIZE]
+        response = spotify_request(token, "/audio-features", {"ids": ",".join(batch)})
+        if response is not None and response.status_code == 403:
+            # Restricted for this app: don't ask again for the lifetime of the process
+            with cache["lock"]:
+                cache["restricted"] = True
+            log_event(logging.WARNING, "audio_features_restricted")
+            break
+        if response is None or response.status_code != 200:
+            break
+        fetched = {}
+        for track_id, features in zip(batch, response.json().get("audio_features", [])):
+            fetched[track_id] = [features[name] for name in MOOD_FEATURES] if features else None
+        with cache["lock"]:
+            cache["features"].update(fetched)
+            while len(cache["features"]) > AUDIO_FEATURE_CACHE_SIZE:
+                cache["features"].popitem(last=False)
+
+    with cache["lock"]:
+        for track_id in track_ids:
+            if track_id in cache["features"]:
+                cache["features"].move_to_end(track_id)
+        return {track_id: cache["features"].get(track_id) for track_id in track_ids}
+
+def get_mood_profile(mood):
+    """
+    Finds the target profile whose keyword appears in the mood name
+    Returns: Feature list in MOOD_FEATURES order, or None if no profile matches
+    """
+    if not mood:
+        return None
+    for keyword, profile in config["mood_profiles"].items():
+        if keyword.lower() in mood.lower():
+            return [profile[name] for name in MOOD_FEATURES]
+    return None
+
+def score_mood_fit(features, profile):
+    """
+    Scores each track's fit to the mood profile in one vectorized pass:
+    1 minus the root-mean-square distance of its features to the target
+    Args:
+        features: Array of shape (tracks, len(MOOD_FEATURES))
+        profile: Target feature list
+    Returns: Array of fit scores between 0 and 1
+    """
+    distances = np.sqrt(np.mean((features - np.asarray(profile)) ** 2, axis=1))
+    return 1.0 - distances
+
+def find_mood_outliers(token, track_uris, mood):
+    """
+    Identifies resolved tracks that don't fit the requested mood:
+    fit below MOOD_FIT_MIN, or more than MOOD_FIT_MAX_Z standard deviations
+    below the playlist average. The worst fits are removed first and at least
+    MOOD_FIT_MIN_TRACKS tracks are always kept.
+    Returns: Set of outlier URIs (empty if the mood has no profile or no features)
+    """
+    profile = get_mood_profile(mood)
+    if profile is None or len(track_uris) <= MOOD_FIT_MIN_TRACKS:
+        return set()
+
+    track_ids = [uri.split(":")[-1] for uri in track_uris]
+    features = fetch_audio_features(token, track_ids)
+    scored = [(uri, features[track_id]) for uri, track_id in zip(track_uris, track_ids) if features[track_id]]
+    if not scored:
+        return set()
+
+    fits = score_mood_fit(np.array([vector for _, vector in scored]), profile)
+    spread = fits.std()
+    z_scores = (fits - fits.mean()) / spread if spread > 0 else np.zeros_like(fits)
+    is_outlier = (fits < MOOD_FIT_MIN) | (z_scores < -MOOD_FIT_MAX_Z)
+
+    max_removals = len(track_uris) - MOOD_FIT_MIN_TRACKS
+    worst_first = [idx for idx in np.argsort(fits) if is_outlier[idx]][:max_removals]
+    log_event(logging.DEBUG, "mood_fit", mood=mood, mean_fit=float(fits.mean()), outliers=len(worst_first))
+    return {scored[idx][0] for idx in worst_first}
+
+def select_mood_outliers(token, track_uris, mood):
+    """
+    Outliers to drop when the mood_fit_scoring flag is on
+    Returns: Set of outlier URIs (always empty with the flag off)
+    """
+    if feature_flags.get("mood_fit_scoring", False) and mood:
+        return find_mood_outliers(token, track_uris, mood)
+    return set()
+
+# ====================================
+# PLAYLIST REFRESH
+# ====================================
+# Spotify accepts at most 100 tracks per add/remove request
+PLAYLIST_BATCH_SIZE = 100
+
+def parse_playlist_id(value):
+    """
+    Extracts the playlist ID from a Spotify playlist URL, URI or bare ID
+    """
+    value = value.strip()
+    if "open.spotify.com/playlist/" in value:
+        value = value.split("open.spotify.com/playlist/", 1)[1]
+    elif value.startswith("spotify:playlist:"):
+        value = value[len("spotify:playlist:"):]
+    return value.split("?", 1)[0].split("/", 1)[0]
+
+def get_playlist_name(token, playlist_id):
+    """
+    Looks up the current name of an existing playlist,
+    first among the playlists created in this session
+    Returns: Playlist name, or None if it can't be read
+    """
+    name = st.session_state.get("created_playlists", {}).get(playlist_id)
+    if name:
+        return name
+    playlist = spotify_get(token, f"/playlists/{playlist_id}", {"fields": "name"})
+    return playlist.get("name") if playlist else None
+
+def get_playlist_track_uris(token, playlist_id):
+    """
+    Fetches the current track URIs of a playlist, following pagination
+    Returns: List of URIs in playlist order, or None on error
+    """
+    url = f"{SPOTIFY_API_URL}/playlists/{playlist_id}/tracks"
+    headers = {"Authorization": f"Bearer {token}"}
+    params = {"fields": "items(track(uri)),next", "limit": PLAYLIST_BATCH_SIZE}
+    uris = []
+    try:
+        while url:
+            response = requests.get(url, headers=headers, params=params)
+            if response.status_code != 200:
+                report_error(f"❌ Error reading playlist: {response.json().get('error', {}).get('message', 'Unknown error')}")
+                return None
+            page = response.json()
+            uris.extend(item["track"]["uri"] for item in page.get("items", []) if item.get("track"))
+            # The next URL already carries the query parameters
+            url, params = page.get("next"), None
+    except Exception as e:
+        report_error(f"❌ Error reading playlist: {str(e)}")
+        return None
+    return uris
+
+def update_playlist_details(token, playlist_id, description):
+    """
+    Updates the description of an existing playlist (the name and URL stay stable)
+    """
+    url = f"{SPOTIFY_API_URL}/playlists/{playlist_id}"
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "Content-Type": "application/json"
+    }
+    try:
+        response = requests.put(url, headers=headers, json={"description": description})
+        if response.status_code != 200:
+            report_error(f"❌ Error updating playlist: {response.json().get('error', {}).get('message', 'Unknown error')}")
+    except Exception as e:
+        report_error(f"❌ Error updating playlist: {str(e)}")
+
+def modify_playlist_tracks(token, playlist_id, method, data, expected_status):
+    """
+    Sends one add/remove/reorder request for a playlist's tracks
+    Returns: True on success
+    """
+    url = f"{SPOTIFY_API_URL}/playlists/{playlist_id}/tracks"
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "Content-Type": "application/json"
+    }
+    try:
+        response = requests.request(method, url, headers=headers, json=data)
+        if response.status_code != expected_status:
+            report_error(f"❌ Error updating playlist tracks: {response.json().get('error', {}).get('message', 'Unknown error')}")
+            return False
+        return True
+    except Exception as e:
+        report_error(f"❌ Error updating playlist tracks: {str(e)}")
+        return False
+
+def longest_increasing_subsequence(values):
+    """
+    Returns: Indexes of one longest strictly increasing subsequence of values
+    """
+    tails, tail_indexes, previous = [], [], [None] * len(values)
+    for idx, value in enumerate(values):
+        length = bisect_left(tails, value)
+        if length == len(tails):
+            tails.append(value)
+            tail_indexes.append(idx)
+        else:
+            tails[length] = value
+            tail_indexes[length] = idx
+        previous[idx] = tail_indexes[length - 1] if length else None
+    indexes = []
+    idx = tail_indexes[-1] if tail_indexes else None
+    while idx is not None:
+        indexes.append(idx)
+        idx = previous[idx]
+    return indexes[::-1]
+
+def sync_playlist_tracks(token, playlist_id, target_uris):
+    """
+    Brings a playlist's tracks to target_uris with minimal changes:
+    1. Removes tracks not in the target (and duplicated ones, which are re-added once)
+    2. Appends missing tracks in batches
+    3. Moves tracks into target order one reorder request at a time, leaving the
+       longest run already in target order in place
+    Every step is computed from the playlist's current contents, so calling this
+    again after a failed batch only applies the remaining changes.
+    Returns: Dictionary with removed/added/moved counts and an ok flag
+    """
+    result = {"removed": 0, "added": 0, "moved": 0, "ok": False}
+    current = get_playlist_track_uris(token, playlist_id)
+    if current is None:
+        return result
+
+    target_uris = list(dict.fromkeys(target_uris))
+    target_set = set(target_uris)
+    to_remove = list(dict.fromkeys(
+        uri for uri in current if uri not in target_set or current.count(uri) > 1
+    ))
+    for start in range(0, len(to_remove), PLAYLIST_BATCH_SIZE):
+        batch = to_remove[start:start + PLAYLIST_BATCH_SIZE]
+        if not modify_playlist_tracks(token, playlist_id, "DELETE", {"tracks": [{"uri": uri} for uri in batch]}, 200):
+            return result
+        result["removed"] += len(batch)
+
+    # Removing a URI drops every occurrence of it
+    removed = set(to_remove)
+    live = [uri for uri in current if uri not in removed]
+    live_set = set(live)
+    to_add = [uri for uri in target_uris if uri not in live_set]
+    for start in range(0, len(to_add), PLAYLIST_BATCH_SIZE):
+        batch = to_add[start:start + PLAYLIST_BATCH_SIZE]
+        if not modify_playlist_tracks(token, playlist_id, "POST", {"uris": batch}, 201):
+            return result
+        live.extend(batch)
+        result["added"] += len(batch)
+
+    target_index = {uri: idx for idx, uri in enumerate(target_uris)}
+    in_place = {live[idx] for idx in longest_increasing_subsequence([target_index[uri] for uri in live])}
+    for idx, uri in enumerate(target_uris):
+        if uri in in_place:
+            continue
+        # Move the track right behind its predecessor in the target order
+        source = live.index(uri)
+        insert_before = live.index(target_uris[idx - 1]) + 1 if idx else 0
+        if not modify_playlist_tracks(token, playlist_id, "PUT", {"range_start": source, "insert_before": insert_before}, 200):
+            return result
+        live.pop(source)
+        live.insert(insert_before - 1 if insert_before > source else insert_before, uri)
+        result["moved"] += 1
+
+    result["ok"] = True
+    return result
+
+def refresh_playlist(token, playlist_id, description, track_uris):
+    """
+    Refreshes an existing playlist in place with newly generated tracks.
+    A failed refresh is kept in session state so it can be resumed.
+    Returns: True if the playlist now matches the new tracks
+    """
+    st.session_state.pending_refresh = {
+        "playlist_id": playlist_id,
+        "description": description,
+        "track_uris": track_uris
+    }
+    update_playlist_details(token, playlist_id, description)
+    result = sync_playlist_tracks(token, playlist_id, track_uris)
+    log_event(logging.INFO, "playlist_refresh", playlist_id=playlist_id, **result)
+    if result["ok"]:
+        del st.session_state.pending_refresh
+    return result["ok"]
+
+def display_pending_refresh():
+    """
+    Offers to resume a refresh whose batches did not all succeed
+    """
+    pending = st.session_state.get("pending_refresh")
+    if not pending:
+        return
+    st.warning("⚠️ The last playlist refresh did not finish.")
+    if st.button("🔁 Resume playlist refresh", key="resume_refresh"):
+        if refresh_playlist(st.session_state.access_token, pending["playlist_id"], pending["description"], pending["track_uris"]):
+            st.success("✅ Playlist refresh completed.")
 
 # ====================================
 # DATA PERSISTENCE
@@ -581,19 +1728,11 @@ def save_playlist_data(user_id, playlist_name, status, playlist_uri, num_songs,
         collection_name = st.secrets["mongodb"]["collection_name"]
 
         try:
-            # Debugging: Log the start of the database connection process
-            if feature_flags.get("debugging", False):
-                st.write("🔍 Debug: Attempting to connect to MongoDB Atlas.")
-
             # Connect to the MongoDB Atlas database
             client = MongoClient(connection_string)
             db = client[database_name]
             collection = db[collection_name]
 
-            # Debugging: Log the connection success
-            if feature_flags.get("debugging", False):
-                st.write("🔍 Debug: Connected to MongoDB Atlas successfully.")
-
             # Prepare data to insert
             date_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             data = {
@@ -606,21 +1745,13 @@ def save_playlist_data(user_id, playlist_name, status, playlist_uri, num_songs,
                 "feature_selected": feature_selected
             }
 
-            # Debugging: Log the data to be inserted
-            if feature_flags.get("debugging", False):
-                st.write("🔍 Debug: Data to be inserted:", data)
-
             # Insert the playlist information
             collection.insert_one(data)
-
-            # Debugging: Log the success of the data insertion
-            if feature_flags.get("debugging", False):
-                st.write("🔍 Debug: Data inserted successfully into MongoDB.")
+            log_event(logging.DEBUG, "mongo_insert", data=data)
 
         except Exception as e:
-            st.error(f"❌ MongoDB error: {e}")
-            if feature_flags.get("debugging", False):
-                st.write("🔍 Debug: Failed to insert data into MongoDB.")
+            report_error(f"❌ MongoDB error: {e}")
+            log_event(logging.ERROR, "mongo_error", error=str(e))
 
 # ====================================
 # USER INTERFACE
@@ -654,6 +1785,9 @@ def main():
     if "access_token" in st.session_state:
         display_playlist_creation_form()
 
+    display_debug_panel()
+    display_profiling_panel()
+
 # ====================================
 # AUTHENTICATION HANDLING
 # ====================================
@@ -676,7 +1810,7 @@ def handle_spotify_authentication(code):
     Stores token in session state
     """
     token_response = requests.post(
-        "https://accounts.spotify.com/api/token",
+        SPOTIFY_TOKEN_URL,
         headers={"Content-Type": "application/x-www-form-urlencoded"},
         data={
             "grant_type": "authorization_code",
@@ -692,6 +1826,269 @@ def handle_spotify_authentication(code):
     else:
         st.error("❌ Authentication error.")
 
+# ====================================
+# PROGRESSIVE RENDERING
+# ====================================
+CANCEL_BUTTON_KEY = "cancel_playlist_run"
+# How often the elapsed time is refreshed while waiting on a slow call
+PROGRESS_POLL_INTERVAL = 0.25
+
+def run_with_progress(status, label, start_time, fn, *args, **kwargs):
+    """
+    Runs fn in a worker thread while showing the elapsed time in the status placeholder.
+    Each refresh is a UI update, which is where Streamlit stops the script when
+    Cancel triggers a rerun; the abandoned call's result is then discarded.
+    Returns: Whatever fn returns
+    """
+    ctx = get_script_run_ctx()
+
+    def run():
+        # fn's errors are shown by the script thread once it finishes
+        add_script_run_ctx(threading.current_thread(), ctx)
+        with collect_errors() as errors:
+            return fn(*args, **kwargs), errors
+
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(run)
+    try:
+        while True:
+            try:
+                result, errors = future.result(timeout=PROGRESS_POLL_INTERVAL)
+                show_errors(errors)
+                return result
+            except FutureTimeoutError:
+                status.caption(f"{label}... {time.time() - start_time:.1f}s")
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+# ====================================
+# PROFILING
+# ====================================
+PROFILE_TOGGLE_KEY = "profile_next_run"
+# Number of profiles kept; older ones are dropped
+PROFILE_STORE_SIZE = 5
+# Seconds between stack samples for the collapsed-stack output
+PROFILE_SAMPLE_INTERVAL = 0.005
+# From Python 3.12 cProfile profiles every thread in the process (slowing all
+# sessions), so only the stack sampler is used there
+PROFILE_WITH_CPROFILE = sys.version_info < (3, 12)
+
+@st.cache_resource
+def get_profile_store():
+    """
+    Process-wide rotating store of the most recent profiles.
+    The counter numbers profiles so their IDs stay unique within a second,
+    and the busy lock allows one profiled run at a time.
+    """
+    return {"lock": threading.Lock(), "busy": threading.Lock(), "profiles": deque(maxlen=PROFILE_STORE_SIZE), "count": 0}
+
+class StackSampler:
+    """
+    Samples one thread's Python stack at a fixed interval and counts
+    collapsed stacks (root;...;leaf) for flame graph tools
+    """
+    def __init__(self, thread_id, interval=PROFILE_SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                key = ";".join(reversed(stack))
+                self.counts[key] = self.counts.get(key, 0) + 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def collapsed(self):
+        return "\n".join(f"{stack} {count}" for stack, count in self.counts.items())
+
+    def summary(self, limit=20):
+        """
+        Most sampled leaf frames with their share of the samples
+        """
+        leaves = {}
+        for stack, count in self.counts.items():
+            leaf = stack.rsplit(";", 1)[-1]
+            leaves[leaf] = leaves.get(leaf, 0) + count
+        total = sum(leaves.values()) or 1
+        top = sorted(leaves.items(), key=lambda item: item[1], reverse=True)[:limit]
+        return "\n".join(f"{count / total:6.1%}  {leaf}" for leaf, count in top)
+
+def run_profiled(fn, *args, **kwargs):
+    """
+    Runs fn under a stack sampler (plus cProfile before Python 3.12) and stores the result:
+    - collapsed stacks of the script thread (flamegraph.pl / speedscope)
+    - pstats data (loadable with pstats.Stats / snakeviz), script thread only
+    Only one run is profiled at a time; others run unprofiled.
+    Returns: Whatever fn returns
+    """
+    store = get_profile_store()
+    if not store["busy"].acquire(blocking=False):
+        st.warning("🧪 Profiling busy: another run is being profiled. Running without profiling.")
+        return fn(*args, **kwargs)
+
+    profiler = cProfile.Profile() if PROFILE_WITH_CPROFILE else None
+    sampler = StackSampler(threading.get_ident())
+    started = datetime.now()
+    try:
+        sampler.start()
+        if profiler:
+            profiler.enable()
+        return fn(*args, **kwargs)
+    finally:
+        if profiler:
+            profiler.disable()
+        sampler.stop()
+        if profiler:
+            profiler.create_stats()
+            summary = io.StringIO()
+            pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(20)
+            summary = summary.getvalue()
+        else:
+            summary = sampler.summary()
+        with store["lock"]:
+            store["count"] += 1
+            store["profiles"].append({
+                "id": f"{started.strftime('%Y%m%d-%H%M%S')}-{store['count']}",
+                "duration": (datetime.now() - started).total_seconds(),
+                "pstats": marshal.dumps(profiler.stats) if profiler else None,
+                "collapsed": sampler.collapsed(),
+                "summary": summary
+            })
+        store["busy"].release()
+
+def display_profiling_panel():
+    """
+    Admin-only toggle to profile the next run and downloads for stored profiles
+    """
+    if not is_admin_session():
+        return
+    with st.expander("🧪 Profiling"):
+        st.checkbox("Profile the next playlist run", key=PROFILE_TOGGLE_KEY)
+        store = get_profile_store()
+        with store["lock"]:
+            profiles = list(store["profiles"])
+        if not profiles:
+            st.caption("No profiles recorded yet.")
+        for profile in reversed(profiles):
+            st.markdown(f"**{profile['id']}** - {profile['duration']:.2f}s")
+            col1, col2 = st.columns(2)
+            with col1:
+                if profile["pstats"] is not None:
+                    st.download_button("⬇️ pstats", profile["pstats"], file_name=f"profile-{profile['id']}.pstats", key=f"pstats_{profile['id']}")
+                else:
+                    st.caption("pstats needs Python < 3.12")
+            with col2:
+                st.download_button("⬇️ collapsed stacks", profile["collapsed"], file_name=f"profile-{profile['id']}.collapsed", key=f"collapsed_{profile['id']}")
+            st.code(profile["summary"], language=None)
+
+# ====================================
+# MULTI-PLAYLIST FAN-OUT
+# ====================================
+# Fan-out jobs running at once across all sessions; further jobs wait their turn
+FAN_OUT_MAX_CONCURRENT_JOBS = feature_flags.get("fan_out_max_concurrent_jobs", 8)
+
+@st.cache_resource
+def get_fan_out_budget():
+    """
+    Process-wide concurrency budget shared by all fan-out requests
+    """
+    return threading.BoundedSemaphore(FAN_OUT_MAX_CONCURRENT_JOBS)
+
+def run_fan_out_job(ctx, budget, token, user_id, generation_args, feature_selection, model, exclude_track_ids=None):
+    """
+    Generates, resolves, mood-filters and creates one playlist of a fan-out request.
+    Runs in a worker thread attached to the session; its errors are collected
+    and returned for the script thread to show.
+    Returns: Dictionary with the genre, playlist name/ID, resolved, removed and
+    added song counts, and the collected errors
+    """
+    add_script_run_ctx(threading.current_thread(), ctx)
+    genre = generation_args["genres"][0]
+    with budget, collect_errors() as errors:
+        run_stats = {}
+        name, description, songs = get_playlist_generator()(**generation_args, model=model, run_stats=run_stats)
+        result = {"genre": genre, "name": name, "playlist_id": None, "resolved": 0, "outliers": 0, "songs": 0, "errors": errors}
+        if not (name and description and songs):
+            record_model_outcome(model, feature_selection, run_stats, 15, 0)
+            save_playlist_data(user_id, name, "fail", "", 0, "")
+            return result
+
+        resolved = list(resolve_playlist_songs(token, songs, exclude_track_ids=exclude_track_ids))
+        track_uris = [uri for _, _, uri, status in resolved if status == "resolved"]
+        result["resolved"] = sum(status != "missing" for _, _, _, status in resolved)
+        record_model_outcome(model, feature_selection, run_stats, len(songs), result["resolved"])
+
+        outliers = select_mood_outliers(token, track_uris, generation_args.get("mood"))
+        track_uris = [uri for uri in track_uris if uri not in outliers]
+        result["outliers"] = len(outliers)
+        result["songs"] = len(track_uris)
+
+        # Parallel jobs often get the same name from the LLM, so it carries the genre
+        result["name"] = generate_unique_playlist_name(f"{name} ({genre})")
+        if track_uris:
+            result["playlist_id"] = create_playlist_with_tracks(token, user_id, result["name"], description, track_uris)
+        if result["playlist_id"]:
+            playlist_url = f"https://open.spotify.com/playlist/{result['playlist_id']}"
+            save_playlist_data(user_id, result["name"], "created", playlist_url, len(songs), feature_selection)
+        else:
+            save_playlist_data(user_id, result["name"], "fail", "", 0, "")
+        return result
+
+def create_fan_out_playlists(user_id, generation_args, feature_selection, model, start_time, exclude_track_ids=None):
+    """
+    Splits the selected genres into one job each and runs them in parallel
+    within the shared budget, showing combined progress as playlists complete
+    """
+    jobs = [{**generation_args, "genres": [genre]} for genre in generation_args["genres"]]
+    progress = st.progress(0.0, text=f"📚 Generating {len(jobs)} playlists...")
+    ctx = get_script_run_ctx()
+    budget = get_fan_out_budget()
+    token = st.session_state.access_token
+
+    created = 0
+    executor = ThreadPoolExecutor(max_workers=len(jobs))
+    try:
+        futures = {
+            executor.submit(run_fan_out_job, ctx, budget, token, user_id, job, feature_selection, model, exclude_track_ids): job["genres"][0]
+            for job in jobs
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                result = future.result()
+            except Exception as e:
+                log_event(logging.ERROR, "fan_out_job_failed", genre=futures[future], error=str(e))
+                result = {"genre": futures[future], "playlist_id": None, "errors": [(f"❌ {futures[future]}: {str(e)}", None)]}
+            progress.progress(done / len(jobs), text=f"📚 {done}/{len(jobs)} playlists ready - {time.time() - start_time:.1f}s")
+            show_errors(result["errors"])
+            if result["playlist_id"]:
+                created += 1
+                playlist_url = f"https://open.spotify.com/playlist/{result['playlist_id']}"
+                removed = f", {result['outliers']} off-mood removed" if result["outliers"] else ""
+                st.success(f"✅ {result['genre']}: [{result['name']}]({playlist_url}) with {result['songs']} songs{removed}")
+                st.session_state.setdefault("created_playlists", {})[result["playlist_id"]] = result["name"]
+            else:
+                st.error(f"❌ {result['genre']}: could not create playlist.")
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    duration = time.time() - start_time
+    st.success(f"✅ Created {created} of {len(jobs)} playlists on Spotify in {duration:.2f} seconds.")
+
 # ====================================
 # PLAYLIST CREATION WORKFLOW
 # ====================================
@@ -703,6 +2100,7 @@ def display_playlist_creation_form():
     
     # Initialize selected_model with default value
     selected_model = "gpt-3.5-turbo"
+    model_options = {}
     
     # Create initial column for user ID
     user_id = st.text_input("Enter your Spotify user ID", placeholder="Spotify Username", label_visibility="collapsed")
@@ -713,14 +2111,31 @@ def display_playlist_creation_form():
         model_options = feature_flags.get("ai_models_config", {
             "gpt-3.5-turbo": "GPT-3.5 Turbo"  # Default if not configured
         })
+        model_labels = {**model_options, AUTO_MODEL: "🤖 Auto (fastest complete playlists)"}
         selected_model = st.selectbox(
             "Select AI Model",
-            options=list(model_options.keys()),
-            format_func=lambda x: model_options[x],
+            options=list(model_labels.keys()),
+            format_func=lambda x: model_labels[x],
             index=0,
             help="Choose the AI model to generate your playlist"
         )
     
+    # Optionally regenerate a playlist we created earlier instead of creating a new one
+    refresh_playlist_id = None
+    if feature_flags.get("playlist_refresh", False):
+        display_pending_refresh()
+        if st.checkbox("🔄 Refresh an existing playlist instead of creating a new one", key="refresh_mode"):
+            created_playlists = st.session_state.get("created_playlists", {})
+            if created_playlists:
+                refresh_playlist_id = st.selectbox(
+                    "Playlist to refresh",
+                    options=list(created_playlists.keys()),
+                    format_func=lambda x: created_playlists[x]
+                )
+            playlist_link = st.text_input("Or paste a playlist link", placeholder="https://open.spotify.com/playlist/...")
+            if playlist_link:
+                refresh_playlist_id = parse_playlist_id(playlist_link)
+    
     # Create two columns for the radio button and band name input
     col1, col2 = st.columns([2, 2])
     
@@ -762,71 +2177,133 @@ def display_playlist_creation_form():
         mood = st.selectbox("😊 Select your desired mood", config["moods"], label_visibility="collapsed")
         genres = st.multiselect("🎸 Select music genres", config["genres"], label_visibility="collapsed")
 
+    # Build the library index in the background while the user fills in a discovery form
+    if feature_flags.get("library_exclusion", False) and feature_selection in DISCOVERY_FEATURES:
+        ensure_library_index(st.session_state.access_token)
+
+    # Offer one playlist per genre when several genres are selected
+    fan_out = False
+    if feature_flags.get("fan_out_playlists", False) and len(genres) > 1 and not refresh_playlist_id:
+        fan_out = st.checkbox(f"📚 Create one playlist per genre ({len(genres)} playlists)", key="fan_out")
+
+    # Clicking Cancel reruns the script, which stops the run in progress
+    if st.session_state.get(CANCEL_BUTTON_KEY):
+        st.warning("⏹️ Playlist generation cancelled.")
+
     # Rest of the function remains the same but uses selected_model
     if st.button("🎵 Generate and Create Playlist 🎵"):
-        if user_id:
-            if feature_selection == "🎼 Music of a Band":
-                if not band_name:
-                    st.warning("⚠️ Please enter a band/artist name.")
-                    return
-            elif feature_selection == "🎸 Underground Music":
-                if not genres:
-                    st.warning("⚠️ Please select at least one genre for underground music exploration.")
-                    return
-            elif not mood or not genres:
-                st.warning("⚠️ Please complete all fields to create the playlist.")
+        if is_admin_session() and st.session_state.get(PROFILE_TOGGLE_KEY):
+            # Profile just this run
+            st.session_state[PROFILE_TOGGLE_KEY] = False
+            run_profiled(generate_and_create_playlist, user_id, feature_selection, band_name, mood, genres, selected_model, model_options, refresh_playlist_id, fan_out)
+        else:
+            generate_and_create_playlist(user_id, feature_selection, band_name, mood, genres, selected_model, model_options, refresh_playlist_id, fan_out)
+
+def generate_and_create_playlist(user_id, feature_selection, band_name, mood, genres, selected_model, model_options, refresh_playlist_id, fan_out=False):
+    """
+    Handles the Generate button:
+    1. Validates the form
+    2. Generates songs with the selected (or auto-routed) model
+    3. Resolves tracks and creates or refreshes the playlist
+    """
+    if user_id:
+        if feature_selection == "🎼 Music of a Band":
+            if not band_name:
+                st.warning("⚠️ Please enter a band/artist name.")
                 return
-                
-            st.info("🎧 Generating songs, name and description...")
-            
-            # Check if the token is valid
-            if not is_token_valid(st.session_state.access_token):
-                st.info("🔄 Refreshing token...")
-                if not refresh_token():
-                    st.error("❌ Could not refresh token. Please re-authenticate.")
-                    return
-            
-            start_time = time.time()
+        elif feature_selection == "🎸 Underground Music":
+            if not genres:
+                st.warning("⚠️ Please select at least one genre for underground music exploration.")
+                return
+        elif not mood or not genres:
+            st.warning("⚠️ Please complete all fields to create the playlist.")
+            return
             
-            # Pass the selected model to generate_playlist_details
-            if feature_selection == "🎸 Underground Music":
-                name, description, songs = generate_playlist_details(
-                    "any",
-                    genres,
-                    hidden_gems=False,
-                    discover_new=False,
-                    songs_from_films=False,
-                    underground_music=True,
-                    band_name=None,
-                    model=selected_model
-                )
-            elif feature_selection == "🎼 Music of a Band":
-                name, description, songs = generate_playlist_details(
-                    "any",
-                    [],
-                    hidden_gems=False,
-                    discover_new=False,
-                    songs_from_films=False,
-                    underground_music=False,
-                    band_name=band_name,
-                    model=selected_model
-                )
-            else:
-                name, description, songs = generate_playlist_details(
-                    mood,
-                    genres,
-                    hidden_gems=(feature_selection == "💎 Hidden Gems"),
-                    discover_new=(feature_selection == "🆕 New Music"),
-                    songs_from_films=(feature_selection == "🎬 Movie Soundtracks"),
-                    underground_music=False,
-                    band_name=None,
-                    model=selected_model
-                )
-            handle_playlist_creation(user_id, name, description, songs, start_time, feature_selection)
+        st.info("🎧 Generating songs, name and description...")
+        
+        # Check if the token is valid
+        if not is_token_valid(st.session_state.access_token):
+            st.info("🔄 Refreshing token...")
+            if not refresh_token():
+                st.error("❌ Could not refresh token. Please re-authenticate.")
+                return
+        
+        start_time = time.time()
+        
+        if feature_flags.get("playlist_refresh", False) and st.session_state.get("refresh_mode") and not refresh_playlist_id:
+            st.warning("⚠️ Please choose the playlist to refresh.")
+            return
+        
+        # Let the router pick the model when "auto" is selected
+        if selected_model == AUTO_MODEL:
+            selected_model = choose_model(list(model_options.keys()), feature_selection)
+            st.info(f"🤖 Auto-selected model: {model_options[selected_model]}")
+        run_stats = {}
+        
+        # Build the generation arguments for the selected feature
+        if feature_selection == "🎸 Underground Music":
+            generation_args = {"mood": "any", "genres": genres, "underground_music": True}
+        elif feature_selection == "🎼 Music of a Band":
+            generation_args = {"mood": "any", "genres": [], "band_name": band_name}
+        else:
+            generation_args = {
+                "mood": mood,
+                "genres": genres,
+                "hidden_gems": feature_selection == "💎 Hidden Gems",
+                "discover_new": feature_selection == "🆕 New Music",
+                "songs_from_films": feature_selection == "🎬 Movie Soundtracks"
+            }
+        
+        # Discovery modes avoid songs already in the user's library. The playlist
+        # being refreshed and the playlists this app created don't count.
+        exclude_track_ids = None
+        if feature_flags.get("library_exclusion", False) and feature_selection in DISCOVERY_FEATURES:
+            library_index = ensure_library_index(st.session_state.access_token)
+            if library_index:
+                generation_args["exclude_songs"] = library_index["recent"]
+                skip_playlist_ids = set(st.session_state.get("created_playlists", {}))
+                if refresh_playlist_id:
+                    skip_playlist_ids.add(refresh_playlist_id)
+                exclude_track_ids = library_exclusions(library_index, skip_playlist_ids)
+        
+        # Fan-out mode creates one playlist per genre in parallel instead
+        if fan_out:
+            create_fan_out_playlists(user_id, generation_args, feature_selection, selected_model, start_time, exclude_track_ids)
+            return
+        
+        # In band mode, fetch the band's catalog while the LLM is generating
+        band_prefetch = None
+        if band_name and feature_selection == "🎼 Music of a Band" and feature_flags.get("band_prefetch", False):
+            band_prefetch = start_band_prefetch(st.session_state.access_token, band_name)
+        
+        # Progressive mode shows live progress and can be cancelled mid-run
+        progressive = feature_flags.get("progressive_rendering", False)
+        if progressive:
+            st.button("⏹️ Cancel", key=CANCEL_BUTTON_KEY)
+            status = st.empty()
+            name, description, songs = run_with_progress(
+                status,
+                "🎧 Generating songs, name and description",
+                start_time,
+                get_playlist_generator(),
+                **generation_args,
+                model=selected_model,
+                run_stats=run_stats
+            )
+            status.empty()
         else:
-            st.warning("⚠️ Please enter your Spotify user ID.")
+            name, description, songs = get_playlist_generator()(
+                **generation_args,
+                model=selected_model,
+                run_stats=run_stats
+            )
+        track_lookup = collect_band_prefetch(band_prefetch) if band_prefetch else None
+        songs_resolved = handle_playlist_creation(user_id, name, description, songs, start_time, feature_selection, progressive, refresh_playlist_id, mood, track_lookup, exclude_track_ids)
+        record_model_outcome(selected_model, feature_selection, run_stats, len(songs) if songs else 15, songs_resolved)
+    else:
+        st.warning("⚠️ Please enter your Spotify user ID.")
 
-def handle_playlist_creation(user_id, name, description, songs, start_time, feature_selection):
+def handle_playlist_creation(user_id, name, description, songs, start_time, feature_selection, progressive=False, refresh_playlist_id=None, mood=None, track_lookup=None, exclude_track_ids=None):
     """
     Orchestrates the playlist creation process:
     1. Validates inputs
@@ -835,51 +2312,91 @@ def handle_playlist_creation(user_id, name, description, songs, start_time, feat
     4. Adds tracks
     5. Shows results
     6. Records creation data
+    In progressive mode a placeholder row is reserved per song and filled as it resolves,
+    with a progress bar showing the current stage and elapsed time.
+    With refresh_playlist_id the existing playlist is updated in place instead.
+    With mood (and the mood_fit_scoring flag) off-mood tracks are dropped before creation.
+    Songs found in track_lookup (title, artist) -> URI skip the Spotify search.
+    Tracks whose ID is in exclude_track_ids (the user's library) are left out.
+    Returns: Number of songs resolved on Spotify
     """
     if name and description and songs:
-        st.success(f"✅ Generated name: {name}")
+        if refresh_playlist_id:
+            # A refreshed playlist keeps its name
+            unique_name = get_playlist_name(st.session_state.access_token, refresh_playlist_id) or name
+            st.success(f"🔄 Refreshing playlist: {unique_name}")
+        else:
+            st.success(f"✅ Generated name: {name}")
+            # Get a unique playlist name
+            unique_name = generate_unique_playlist_name(name)
         st.info(f"📜 Generated description: {description}")
         st.success(f"🎵 Generated songs:")
         
-        # Get a unique playlist name
-        unique_name = generate_unique_playlist_name(name)
-        
         st.markdown("<div style='margin-bottom: 10px'><b>Legend:</b> ⭐ = Top Hit | 💎 = Hidden Gem | 🆕 = New Music | 🎬 = Movie Soundtrack | 🎸 = Underground Music</div>", unsafe_allow_html=True)
         
         # Determine if underground music is selected
         is_underground = feature_selection == "🎸 Underground Music"
         
+        if progressive:
+            progress = st.progress(0.0)
+            rows = [st.empty() for _ in songs]
+            for idx, (row, song) in enumerate(zip(rows, songs), 1):
+                row.caption(f"{idx}. ⏳ {song['title']} - {song['artist']}")
+        
         track_uris = []
-        for idx, song in enumerate(songs, 1):
+        resolved_songs = {}
+        known_songs = 0
+        for idx, song, uri, status in resolve_playlist_songs(st.session_state.access_token, songs, track_lookup, exclude_track_ids):
             title = song['title']
             artist = song['artist']
-            is_hidden_gem = song.get('is_hidden_gem', False)
-            is_new_music = song.get('is_new_music', False)
-            is_from_film = song.get('is_from_film', False)
             
-            search_response = search_tracks(st.session_state.access_token, title, artist, song.get('year', ''))
-            if "tracks" in search_response and search_response["tracks"]["items"]:
-                track_uris.append(search_response["tracks"]["items"][0]["uri"])
-                icons = []
-                if is_hidden_gem:
-                    icons.append("💎")
-                if is_new_music:
-                    icons.append("🆕")
-                if is_from_film:
-                    icons.append("🎬")
-                if is_underground:
-                    icons.append("🎸")
-                if not icons:
-                    icons.append("⭐")
-                year = song.get('year', 'N/A')
-                st.write(f"{idx}. **{title}** - {artist} ({year}) {' '.join(icons)}")
+            known_songs += status == "known"
+            if status == "resolved":
+                track_uris.append(uri)
+                resolved_songs[uri] = (idx, song)
+            
+            if progressive:
+                if status == "known":
+                    rows[idx - 1].caption(f"{idx}. ~~{title} - {artist}~~ (already in your library)")
+                elif status == "resolved":
+                    rows[idx - 1].write(format_song_line(idx, song, is_underground))
+                else:
+                    rows[idx - 1].caption(f"{idx}. ~~{title} - {artist}~~ (not found on Spotify)")
+                progress.progress(
+                    idx / len(songs),
+                    text=f"🔎 Resolved {idx}/{len(songs)} songs - {time.time() - start_time:.1f}s"
+                )
+            elif status == "resolved":
+                st.write(format_song_line(idx, song, is_underground))
+        songs_resolved = len(track_uris) + known_songs
+        if known_songs:
+            st.info(f"🔁 Skipped {known_songs} songs already in your library.")
+
+        # Drop resolved tracks whose audio features don't fit the requested mood
+        outliers = select_mood_outliers(st.session_state.access_token, track_uris, mood)
+        if outliers:
+            track_uris = [uri for uri in track_uris if uri not in outliers]
+            removed = sorted(resolved_songs[uri] for uri in outliers)
+            if progressive:
+                for idx, song in removed:
+                    rows[idx - 1].caption(f"{idx}. ~~{song['title']} - {song['artist']}~~ (doesn't fit the mood)")
+            st.info("🎯 Removed songs that don't fit the mood: " + ", ".join(f"{song['title']} - {song['artist']}" for _, song in removed))
+
+        if progressive and track_uris:
+            progress.progress(1.0, text=f"📀 Creating playlist - {time.time() - start_time:.1f}s")
 
         if track_uris:
-            playlist_response = create_playlist(st.session_state.access_token, user_id, unique_name, description)
-            if "id" in playlist_response:
-                playlist_id = playlist_response["id"]
-                add_tracks_to_playlist(st.session_state.access_token, playlist_id, track_uris)
-                
+            if refresh_playlist_id:
+                # Apply only the differences to the existing playlist
+                playlist_id = None
+                if refresh_playlist(st.session_state.access_token, refresh_playlist_id, description, track_uris):
+                    playlist_id = refresh_playlist_id
+            else:
+                playlist_id = create_playlist_with_tracks(st.session_state.access_token, user_id, unique_name, description, track_uris)
+                if playlist_id:
+                    st.session_state.setdefault("created_playlists", {})[playlist_id] = unique_name
+            
+            if playlist_id:
                 # End the timer
                 end_time = time.time()
                 duration = end_time - start_time
@@ -887,7 +2404,10 @@ def handle_playlist_creation(user_id, name, description, songs, start_time, feat
                 # Generate Spotify URL from URI
                 playlist_url = f"https://open.spotify.com/playlist/{playlist_id}"
                 
-                st.success(f"✅ Playlist '{unique_name}' successfully created on Spotify - created in {duration:.2f} seconds.")
+                if refresh_playlist_id:
+                    st.success(f"✅ Playlist successfully refreshed on Spotify - refreshed in {duration:.2f} seconds.")
+                else:
+                    st.success(f"✅ Playlist '{unique_name}' successfully created on Spotify - created in {duration:.2f} seconds.")
                 
                 # Display a styled button with a link to the playlist
                 st.markdown(f"""
@@ -908,27 +2428,79 @@ def handle_playlist_creation(user_id, name, description, songs, start_time, feat
                 """, unsafe_allow_html=True)
 
                 # Save playlist data
-                save_playlist_data(user_id, unique_name, "created", playlist_url, len(songs), feature_selection)
+                save_playlist_data(user_id, unique_name, "refreshed" if refresh_playlist_id else "created", playlist_url, len(songs), feature_selection)
+            elif refresh_playlist_id:
+                st.error("❌ Could not refresh playlist on Spotify.")
+                save_playlist_data(user_id, unique_name, "fail", "", 0, "")
             else:
                 st.error("❌ Could not create playlist on Spotify.")
                 save_playlist_data(user_id, unique_name, "fail", "", 0, "")
+        return songs_resolved
     else:
         st.error("❌ Could not generate playlist.")
         save_playlist_data(user_id, name, "fail", "", 0, "")
+        return 0
+
+def resolve_playlist_songs(token, songs, track_lookup=None, exclude_track_ids=None):
+    """
+    Resolves generated songs one at a time so callers can show progress
+    Yields: (idx, song, uri, status) with status "resolved", "known"
+    (already in the user's library) or "missing" (not found on Spotify)
+    """
+    for idx, song in enumerate(songs, 1):
+        uri = resolve_song(token, song, track_lookup)
+        if uri is None:
+            yield idx, song, None, "missing"
+        elif exclude_track_ids is not None and uri.split(":")[-1] in exclude_track_ids:
+            yield idx, song, uri, "known"
+        else:
+            yield idx, song, uri, "resolved"
+
+def resolve_song(token, song, track_lookup=None):
+    """
+    Finds the Spotify URI for a generated song, using the prefetched
+    lookup first and falling back to a search
+    Returns: Track URI, or None if not found
+    """
+    if track_lookup:
+        key = (normalize_track_key(song['title']), normalize_track_key(song['artist']))
+        if key in track_lookup:
+            return track_lookup[key]
+    search_response = search_tracks(token, song['title'], song['artist'], song.get('year', ''))
+    if "tracks" in search_response and search_response["tracks"]["items"]:
+        return search_response["tracks"]["items"][0]["uri"]
+    return None
+
+def format_song_line(idx, song, is_underground):
+    """
+    Formats a resolved song for display with its feature icons
+    """
+    icons = []
+    if song.get('is_hidden_gem', False):
+        icons.append("💎")
+    if song.get('is_new_music', False):
+        icons.append("🆕")
+    if song.get('is_from_film', False):
+        icons.append("🎬")
+    if is_underground:
+        icons.append("🎸")
+    if not icons:
+        icons.append("⭐")
+    year = song.get('year', 'N/A')
+    return f"{idx}. **{song['title']}** - {song['artist']} ({year}) {' '.join(icons)}"
 
 def generate_unique_playlist_name(desired_name):
     # Generate a 4-digit timestamp
     timestamp = int(time.time()) % 10000  # Get the last 4 digits of the current timestamp
     unique_name = f"{desired_name} - {timestamp:04d}"
     
-    if feature_flags.get("debugging", False):
-        st.write(f"🔍 Debug: Generated unique playlist name: '{unique_name}'")
+    log_event(logging.DEBUG, "unique_playlist_name", name=unique_name)
     
     return unique_name
 
 def is_token_valid(token):
     # Check if the token is valid by making a simple request
-    url = "https://api.spotify.com/v1/me"
+    url = f"{SPOTIFY_API_URL}/me"
     headers = {"Authorization": f"Bearer {token}"}
     response = requests.get(url, headers=headers)
     return response.status_code == 200
@@ -937,7 +2509,7 @@ def refresh_token():
     # Refresh the token using the refresh token
     refresh_token = st.secrets["SPOTIFY_REFRESH_TOKEN"]
     response = requests.post(
-        "https://accounts.spotify.com/api/token",
+        SPOTIFY_TOKEN_URL,
         headers={"Content-Type": "application/x-www-form-urlencoded"},
         data={
             "grant_type": "refresh_token",
@@ -0,0 +1,177 @@
+"""
+Incremental export of the playlist history recorded by save_playlist_data.
+
+Streams the MongoDB collection with a batched cursor ordered by _id and writes
+one compressed file per day and batch (JSONL by default, Parquet if pyarrow is
+installed) under <out-dir>/day=YYYY-MM-DD/. Only records newer than the last
+exported _id (kept in <out-dir>/_watermark.json) are read, and at most one
+batch is held in memory at a time.
+
+ObjectIds are generated by the app processes and only ordered to the second,
+so a record can be inserted after a run with a smaller _id than the watermark.
+Records are therefore only exported once their _id is older than --lag-seconds,
+which must exceed the insert delay and clock skew between app hosts.
+
+Usage:
+    python export_playlist_history.py --out-dir exports
+    python export_playlist_history.py --out-dir exports --format parquet --batch-size 5000
+    python export_playlist_history.py --out-dir exports --lag-seconds 900
+"""
+import argparse
+import json
+import os
+import sys
+import tomllib
+from datetime import datetime, timedelta, timezone
+
+import pandas as pd
+from bson import ObjectId
+from pymongo import MongoClient
+
+WATERMARK_FILE = "_watermark.json"
+FILE_EXTENSIONS = {"jsonl": "jsonl.gz", "parquet": "parquet"}
+DEFAULT_LAG_SECONDS = 300
+
+# ====================================
+# CONFIGURATION
+# ====================================
+def load_mongodb_settings(args):
+    """
+    Resolves the MongoDB settings:
+    - Command line arguments first
+    - Then the [mongodb] section of the app's Streamlit secrets file
+    """
+    settings = {}
+    if os.path.exists(args.secrets):
+        with open(args.secrets, "rb") as secrets_file:
+            settings = tomllib.load(secrets_file).get("mongodb", {})
+    for key in ("connection_string", "database_name", "collection_name"):
+        value = getattr(args, key)
+        if value:
+            settings[key] = value
+        if not settings.get(key):
+            sys.exit(f"Missing MongoDB setting '{key}' (pass --{key.replace('_', '-')} or set it in {args.secrets})")
+    return settings
+
+# ====================================
+# WATERMARK
+# ====================================
+def load_watermark(out_dir):
+    """
+    Returns: The last exported _id, or None for a full export
+    """
+    path = os.path.join(out_dir, WATERMARK_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as watermark_file:
+        return ObjectId(json.load(watermark_file)["last_id"])
+
+def save_watermark(out_dir, last_id, exported_this_run):
+    """
+    Atomically records the last exported _id once its batch is on disk
+    """
+    path = os.path.join(out_dir, WATERMARK_FILE)
+    with open(f"{path}.tmp", "w") as watermark_file:
+        json.dump({
+            "last_id": str(last_id),
+            "exported_this_run": exported_this_run,
+            "updated_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        }, watermark_file)
+    os.replace(f"{path}.tmp", path)
+
+# ====================================
+# EXPORT
+# ====================================
+def iter_batches(collection, after_id, before_id, batch_size):
+    """
+    Streams documents newer than after_id and older than before_id in _id order,
+    batch_size at a time
+    """
+    query = {"_id": {"$lt": before_id}}
+    if after_id:
+        query["_id"]["$gt"] = after_id
+    batch = []
+    for document in collection.find(query, sort=[("_id", 1)], batch_size=batch_size):
+        batch.append(document)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def batch_to_frame(batch):
+    """
+    Converts a batch of documents to a DataFrame with a day column.
+    The day comes from date_time, falling back to the _id creation time.
+    """
+    frame = pd.DataFrame(batch)
+    frame["day"] = [
+        str(document.get("date_time") or "")[:10] or document["_id"].generation_time.strftime("%Y-%m-%d")
+        for document in batch
+    ]
+    frame["_id"] = frame["_id"].astype(str)
+    return frame
+
+def write_partitions(frame, out_dir, file_format):
+    """
+    Writes one file per day in the batch. Files are named after their first _id,
+    so re-running an interrupted batch overwrites rather than duplicates it.
+    """
+    for day, rows in frame.groupby("day", sort=True):
+        day_dir = os.path.join(out_dir, f"day={day}")
+        os.makedirs(day_dir, exist_ok=True)
+        path = os.path.join(day_dir, f"part-{rows['_id'].iloc[0]}.{FILE_EXTENSIONS[file_format]}")
+        rows = rows.drop(columns="day")
+        if file_format == "parquet":
+            rows.to_parquet(f"{path}.tmp", index=False, compression="snappy")
+        else:
+            rows.to_json(f"{path}.tmp", orient="records", lines=True, compression="gzip")
+        os.replace(f"{path}.tmp", path)
+
+def export_history(collection, out_dir, file_format="jsonl", batch_size=1000, lag_seconds=DEFAULT_LAG_SECONDS):
+    """
+    Exports every record newer than the watermark and older than lag_seconds
+    Returns: Number of records exported
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    last_id = load_watermark(out_dir)
+    cutoff_id = ObjectId.from_datetime(datetime.now(timezone.utc) - timedelta(seconds=lag_seconds))
+    exported = 0
+    for batch in iter_batches(collection, last_id, cutoff_id, batch_size):
+        write_partitions(batch_to_frame(batch), out_dir, file_format)
+        exported += len(batch)
+        save_watermark(out_dir, batch[-1]["_id"], exported)
+    return exported
+
+# ====================================
+# ENTRY POINT
+# ====================================
+def main():
+    parser = argparse.ArgumentParser(description="Incremental export of the playlist history collection")
+    parser.add_argument("--out-dir", required=True, help="Directory for the day partitions and watermark")
+    parser.add_argument("--format", choices=sorted(FILE_EXTENSIONS), default="jsonl", help="Output file format")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Records read and written per batch")
+    parser.add_argument("--lag-seconds", type=int, default=DEFAULT_LAG_SECONDS, help="Only export records whose _id is older than this")
+    parser.add_argument("--secrets", default=os.path.join(".streamlit", "secrets.toml"), help="Streamlit secrets file")
+    parser.add_argument("--connection-string", dest="connection_string", help="MongoDB connection string")
+    parser.add_argument("--database-name", dest="database_name", help="MongoDB database name")
+    parser.add_argument("--collection-name", dest="collection_name", help="MongoDB collection name")
+    args = parser.parse_args()
+
+    if args.format == "parquet":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            sys.exit("Parquet export requires pyarrow (pip install pyarrow)")
+
+    settings = load_mongodb_settings(args)
+    client = MongoClient(settings["connection_string"])
+    try:
+        collection = client[settings["database_name"]][settings["collection_name"]]
+        exported = export_history(collection, args.out_dir, args.format, args.batch_size, args.lag_seconds)
+    finally:
+        client.close()
+    print(f"Exported {exported} records to {args.out_dir}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,792 @@
+"""
+Concurrent-session load test for ListCreator2.py.
+
+Drives many simulated Streamlit sessions (via streamlit.testing AppTest) through
+authentication, form submission and playlist creation against local fake
+Spotify, LLM and MongoDB servers with configurable latency. The fakes run in
+a separate process, so the thread count and RSS memory describe only the app.
+Sessions rotate through mood, band, discovery, refresh, fan-out and auto model
+scenarios with the matching feature flags on; flags that change every run
+(progressive rendering, sharded generation) are enabled with --flags.
+Reports throughput, latency percentiles, thread count and RSS memory for each
+concurrency level, how often each scenario's stage took effect, and the
+Spotify endpoints reached.
+
+Usage:
+    python load_test.py --levels 1,5,10,25 --sessions 25
+    python load_test.py --levels 5 --flags progressive_rendering,sharded_generation
+"""
+import argparse
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import random
+import re
+import resource
+import socketserver
+import struct
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import bson
+import streamlit
+from streamlit import config as streamlit_config
+from streamlit.logger import set_log_level
+from streamlit.runtime import Runtime
+from streamlit.runtime.scriptrunner import magic
+from streamlit.runtime.secrets import Secrets
+from streamlit.testing.v1 import AppTest
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ListCreator2.py")
+
+FAKE_MOODS = ["Happy", "Sad", "Energetic", "Relaxed"]
+FAKE_GENRES = ["Rock", "Pop", "Jazz", "Electronic"]
+FAKE_BAND = "Fake Artist"
+
+# Sessions rotate through these, so every flag-gated stage runs under load:
+# mood fit scoring, band prefetch, library exclusion, playlist refresh,
+# multi-playlist fan-out and automatic model routing
+SCENARIOS = ["mood", "band", "discovery", "refresh", "fan_out", "auto_model"]
+# Flags a scenario needs on top of the ones build_secrets always enables
+SCENARIO_FLAGS = {"fan_out": ["fan_out_playlists"], "auto_model": ["ai_models"]}
+# Models offered when ai_models is on; all of them are answered by the fake LLM
+FAKE_MODELS = {"gpt-3.5-turbo": "GPT-3.5 Turbo", "gpt-4o-mini": "GPT-4o Mini", "deepseek-chat": "DeepSeek Chat"}
+
+# ====================================
+# LATENCY MODEL
+# ====================================
+def simulate_latency(mean_seconds, jitter=0.25):
+    """
+    Sleeps for a gaussian latency around mean_seconds (never negative)
+    """
+    if mean_seconds > 0:
+        time.sleep(max(0.0, random.gauss(mean_seconds, mean_seconds * jitter)))
+
+# ====================================
+# FAKE HTTP SERVERS
+# ====================================
+class FakeApiHandler(BaseHTTPRequestHandler):
+    """
+    Base handler for the fake JSON APIs:
+    - Reads the request body
+    - Applies the configured latency
+    - Sends JSON responses
+    """
+    latency = 0.0
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length) if length else b""
+        try:
+            return json.loads(body) if body else {}
+        except json.JSONDecodeError:
+            return {}
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def fake_audio_features(track_id):
+    """
+    Deterministic audio features derived from the track ID
+    """
+    digest = hashlib.md5(track_id.encode()).digest()
+    names = ["valence", "energy", "danceability", "acousticness"]
+    features = {name: digest[idx] / 255 for idx, name in enumerate(names)}
+    features["id"] = track_id
+    return features
+
+def fake_search_track_id(query):
+    """
+    Deterministic track ID for a search query
+    """
+    return hashlib.md5(query.encode()).hexdigest()[:22]
+
+def fake_saved_track(idx):
+    """
+    Saved library item for the fake LLM's "Song N", so library exclusion has matches
+    """
+    track_id = fake_search_track_id(f"track:Song {idx} artist:Artist {idx} year:{2000 + idx}")
+    return {"track": {"id": track_id, "uri": f"spotify:track:{track_id}", "name": f"Song {idx}", "artists": [{"name": f"Artist {idx}"}]}}
+
+def fake_catalog_track(idx):
+    """
+    Catalog track matching the fake LLM's "Song N" by "Artist N"
+    """
+    track_id = hashlib.md5(f"catalog-{idx}".encode()).hexdigest()[:22]
+    return {"id": track_id, "uri": f"spotify:track:{track_id}", "name": f"Song {idx}", "artists": [{"name": f"Artist {idx}"}]}
+
+class FakeSpotifyHandler(FakeApiHandler):
+    """
+    Minimal stand-in for the Spotify accounts and Web API endpoints used by the app.
+    Search results are deterministic per query and playlist contents are kept in
+    memory, so refreshes see the tracks added by earlier runs. Requests are
+    counted per endpoint to show which stages the sessions reached.
+    """
+    playlists = {}
+    hits = Counter()
+    lock = threading.Lock()
+
+    def count_hit(self):
+        route = re.sub(r"/(playlists|artists|users)/[^/]+", r"/\1/{id}", urlparse(self.path).path)
+        with self.lock:
+            self.hits[f"{self.command} {route}"] += 1
+
+    def playlist_id(self, path):
+        return path.split("/")[3]
+
+    def send_page(self, items, query):
+        offset = int(query.get("offset", ["0"])[0])
+        limit = int(query.get("limit", ["50"])[0])
+        self.send_json(200, {"items": items[offset:offset + limit], "total": len(items), "next": None})
+
+    def do_GET(self):
+        self.count_hit()
+        simulate_latency(self.latency)
+        url = urlparse(self.path)
+        path = url.path
+        query = parse_qs(url.query)
+        if path == "/v1/me":
+            self.send_json(200, {"id": "loadtest-user"})
+        elif path == "/v1/search" and query.get("type") == ["artist"]:
+            self.send_json(200, {"artists": {"items": [{"id": "fake-artist", "name": "Fake Artist"}]}})
+        elif path == "/v1/search":
+            track_id = fake_search_track_id(query["q"][0])
+            self.send_json(200, {"tracks": {"items": [{"id": track_id, "uri": f"spotify:track:{track_id}"}]}})
+        elif path == "/v1/me/tracks":
+            saved = [fake_saved_track(idx) for idx in range(1, 6)]
+            self.send_page(saved, query)
+        elif path == "/v1/me/playlists":
+            with self.lock:
+                playlists = [
+                    {"id": playlist_id, "snapshot_id": hashlib.md5("".join(uris).encode()).hexdigest()}
+                    for playlist_id, uris in self.playlists.items()
+                ]
+            self.send_page(playlists, query)
+        elif path.startswith("/v1/artists/") and path.endswith("/top-tracks"):
+            self.send_json(200, {"tracks": [fake_catalog_track(idx) for idx in range(1, 11)]})
+        elif path.startswith("/v1/artists/") and path.endswith("/albums"):
+            self.send_json(200, {"items": [{"id": "fake-album-1"}, {"id": "fake-album-2"}]})
+        elif path.startswith("/v1/artists/") and path.endswith("/related-artists"):
+            self.send_json(200, {"artists": [{"id": "fake-related-1"}, {"id": "fake-related-2"}]})
+        elif path == "/v1/albums":
+            ids = query.get("ids", [""])[0].split(",")
+            self.send_json(200, {"albums": [
+                {"id": album_id, "tracks": {"items": [fake_catalog_track(idx) for idx in range(11, 21)]}}
+                for album_id in ids
+            ]})
+        elif path == "/v1/audio-features":
+            ids = query.get("ids", [""])[0].split(",")
+            self.send_json(200, {"audio_features": [fake_audio_features(track_id) for track_id in ids]})
+        elif path.startswith("/v1/playlists/") and path.endswith("/tracks"):
+            with self.lock:
+                uris = list(self.playlists.get(self.playlist_id(path), []))
+            self.send_page([{"track": {"id": uri.split(":")[-1], "uri": uri}} for uri in uris], query)
+        else:
+            self.send_json(404, {"error": {"message": f"Unknown path {path}"}})
+
+    def do_POST(self):
+        self.count_hit()
+        request = self.read_json()
+        simulate_latency(self.latency)
+        path = urlparse(self.path).path
+        if path == "/api/token":
+            self.send_json(200, {"access_token": "fake-token", "token_type": "Bearer", "expires_in": 3600})
+        elif path.startswith("/v1/users/") and path.endswith("/playlists"):
+            playlist_id = f"{random.getrandbits(64):016x}"
+            with self.lock:
+                self.playlists[playlist_id] = []
+            self.send_json(201, {"id": playlist_id})
+        elif path.startswith("/v1/playlists/") and path.endswith("/tracks"):
+            with self.lock:
+                self.playlists.setdefault(self.playlist_id(path), []).extend(request.get("uris", []))
+            self.send_json(201, {"snapshot_id": "fake-snapshot"})
+        else:
+            self.send_json(404, {"error": {"message": f"Unknown path {path}"}})
+
+    def do_PUT(self):
+        self.count_hit()
+        request = self.read_json()
+        simulate_latency(self.latency)
+        path = urlparse(self.path).path
+        if path.startswith("/v1/playlists/") and path.endswith("/tracks"):
+            with self.lock:
+                uris = self.playlists.setdefault(self.playlist_id(path), [])
+                start, before = request["range_start"], request["insert_before"]
+                uri = uris.pop(start)
+                uris.insert(before if before < start else before - 1, uri)
+            self.send_json(200, {"snapshot_id": "fake-snapshot"})
+        elif path.startswith("/v1/playlists/"):
+            self.send_json(200, {})
+        else:
+            self.send_json(404, {"error": {"message": f"Unknown path {path}"}})
+
+    def do_DELETE(self):
+        self.count_hit()
+        request = self.read_json()
+        simulate_latency(self.latency)
+        path = urlparse(self.path).path
+        if path.startswith("/v1/playlists/") and path.endswith("/tracks"):
+            removed = {track["uri"] for track in request.get("tracks", [])}
+            with self.lock:
+                uris = self.playlists.setdefault(self.playlist_id(path), [])
+                uris[:] = [uri for uri in uris if uri not in removed]
+            self.send_json(200, {"snapshot_id": "fake-snapshot"})
+        else:
+            self.send_json(404, {"error": {"message": f"Unknown path {path}"}})
+
+class FakeLLMHandler(FakeApiHandler):
+    """
+    Minimal stand-in for the OpenAI chat completions endpoint.
+    Answers with as many songs as the system prompt asks for (drawn from a pool
+    of 25 songs), and no songs when the prompt asks for none. Conflicting counts
+    in one prompt are answered with the largest, like a confused model would.
+    The latency scales with the number of songs, like decoding a longer
+    completion would.
+    """
+    def do_POST(self):
+        request = self.read_json()
+        system_prompt = request["messages"][0]["content"]
+        counts = [int(exact or sized) for exact, sized in re.findall(r"exactly (\d+) songs|(\d+)-song playlist", system_prompt)]
+        song_count = max(counts, default=0)
+        simulate_latency(self.latency * (0.2 + 0.8 * song_count / 15))
+        playlist = {
+            "name": "Load Test Mix",
+            "description": "Synthetic playlist generated by the load test",
+            "songs": [
+                {
+                    "title": f"Song {idx}",
+                    "artist": f"Artist {idx}",
+                    "year": 2000 + idx,
+                    "is_hidden_gem": False,
+                    "is_new_music": False,
+                    "is_from_film": False
+                }
+                for idx in random.sample(range(1, 26), min(song_count, 25))
+            ]
+        }
+        self.send_json(200, {
+            "id": "chatcmpl-loadtest",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "gpt-3.5-turbo"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": json.dumps(playlist)},
+                "finish_reason": "stop"
+            }],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+        })
+
+def start_http_server(handler, latency):
+    """
+    Starts a threaded HTTP server for a fake API on a free local port
+    Returns: (server, base_url)
+    """
+    handler_class = type(handler.__name__, (handler,), {"latency": latency})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler_class)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+# ====================================
+# FAKE MONGODB SERVER
+# ====================================
+OP_REPLY = 1
+OP_QUERY = 2004
+OP_MSG = 2013
+
+class FakeMongoHandler(socketserver.BaseRequestHandler):
+    """
+    Speaks just enough of the MongoDB wire protocol for pymongo:
+    - Handshake (hello / isMaster) over OP_QUERY or OP_MSG
+    - insert, ping and any other command answered with ok: 1
+    Inserted documents are counted on the server.
+    """
+    latency = 0.0
+
+    def handle(self):
+        while True:
+            header = self.read_exactly(16)
+            if not header:
+                return
+            length, request_id, _, op_code = struct.unpack("<iiii", header)
+            payload = self.read_exactly(length - 16)
+            if payload is None:
+                return
+            if op_code == OP_QUERY:
+                command = self.parse_op_query(payload)
+                self.send_reply(request_id, self.run_command(command), legacy=True)
+            elif op_code == OP_MSG:
+                command, documents = self.parse_op_msg(payload)
+                if documents:
+                    simulate_latency(self.latency)
+                    with self.server.lock:
+                        self.server.inserted += len(documents)
+                self.send_reply(request_id, self.run_command(command, len(documents)))
+            else:
+                return
+
+    def read_exactly(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def parse_op_query(self, payload):
+        name_end = payload.index(b"\x00", 4)
+        return bson.decode(payload[name_end + 9:])
+
+    def parse_op_msg(self, payload):
+        position = 4
+        command = {}
+        documents = []
+        while position < len(payload):
+            kind = payload[position]
+            position += 1
+            size = struct.unpack_from("<i", payload, position)[0]
+            if kind == 0:
+                command = bson.decode(payload[position:position + size])
+            elif kind == 1:
+                section = payload[position + 4:position + size]
+                section = section[section.index(b"\x00") + 1:]
+                documents.extend(bson.decode_all(section))
+            else:
+                break
+            position += size
+        return command, documents
+
+    def run_command(self, command, num_documents=0):
+        name = next(iter(command), "").lower()
+        if name in ("hello", "ismaster"):
+            return {
+                "helloOk": True,
+                "ismaster": True,
+                "isWritablePrimary": True,
+                "maxBsonObjectSize": 16 * 1024 * 1024,
+                "maxMessageSizeBytes": 48000000,
+                "maxWriteBatchSize": 100000,
+                "localTime": time.time(),
+                "minWireVersion": 0,
+                "maxWireVersion": 21,
+                "ok": 1.0
+            }
+        if name == "insert":
+            return {"n": num_documents, "ok": 1.0}
+        return {"ok": 1.0}
+
+    def send_reply(self, request_id, document, legacy=False):
+        body = bson.encode(document)
+        if legacy:
+            message = struct.pack("<iqii", 0, 0, 0, 1) + body
+            op_code = OP_REPLY
+        else:
+            message = struct.pack("<iB", 0, 0) + body
+            op_code = OP_MSG
+        header = struct.pack("<iiii", 16 + len(message), 0, request_id, op_code)
+        self.request.sendall(header + message)
+
+class FakeMongoServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, handler):
+        super().__init__(address, handler)
+        self.lock = threading.Lock()
+        self.inserted = 0
+
+def start_mongo_server(latency):
+    """
+    Starts the fake MongoDB server on a free local port
+    Returns: (server, connection_string)
+    """
+    handler_class = type("FakeMongoHandler", (FakeMongoHandler,), {"latency": latency})
+    server = FakeMongoServer(("127.0.0.1", 0), handler_class)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+    return server, f"mongodb://127.0.0.1:{port}/?directConnection=true&serverSelectionTimeoutMS=5000"
+
+def serve_fakes(conn, spotify_latency, llm_latency, mongo_latency):
+    """
+    Runs the fake servers until told to stop; meant to run in its own process.
+    Sends the (Spotify, LLM, MongoDB) URLs once listening, and the Spotify
+    request counts and MongoDB insert count once stopped.
+    """
+    spotify_server, spotify_url = start_http_server(FakeSpotifyHandler, spotify_latency)
+    llm_server, llm_url = start_http_server(FakeLLMHandler, llm_latency)
+    mongo_server, mongo_url = start_mongo_server(mongo_latency)
+    conn.send((spotify_url, llm_url, mongo_url))
+    conn.recv()
+    for server in (spotify_server, llm_server, mongo_server):
+        server.shutdown()
+    conn.send((dict(FakeSpotifyHandler.hits), mongo_server.inserted))
+
+# ====================================
+# SIMULATED SESSIONS
+# ====================================
+def build_secrets(spotify_url, llm_url, mongo_url, extra_flags=()):
+    """
+    Secrets pointing the app at the local fakes, with extra_flags enabled
+    on top of the default feature flags
+    """
+    secrets = {
+        "SPOTIFY_CLIENT_ID": "fake-client-id",
+        "SPOTIFY_CLIENT_SECRET": "fake-client-secret",
+        "SPOTIFY_REFRESH_TOKEN": "fake-refresh-token",
+        "OPENAI_API_KEY": "fake-openai-key",
+        "SPOTIFY_ACCOUNTS_URL": spotify_url,
+        "SPOTIFY_API_URL": f"{spotify_url}/v1",
+        "OPENAI_BASE_URL": f"{llm_url}/v1",
+        "DEEPSEEK_API_KEY": "fake-deepseek-key",
+        "DEEPSEEK_API_URL": f"{llm_url}/v1/chat/completions",
+        "config": {"moods": FAKE_MOODS, "genres": FAKE_GENRES},
+        "feature_flags": {
+            "debugging": False,
+            "playlist_data_record": True,
+            "hidden_gems": True,
+            "band_music": True,
+            "mood_fit_scoring": True,
+            "band_prefetch": True,
+            "library_exclusion": True,
+            "playlist_refresh": True,
+            "ai_models_config": FAKE_MODELS
+        },
+        "mongodb": {
+            "connection_string": mongo_url,
+            "database_name": "loadtest",
+            "collection_name": "playlists"
+        }
+    }
+    secrets["feature_flags"].update(dict.fromkeys(extra_flags, True))
+    return secrets
+
+def install_secrets(secrets):
+    """
+    Installs the secrets process-wide once. AppTest swaps st.secrets in and out
+    around each run when given per-test secrets, which races between
+    concurrent sessions, so the sessions share one global copy instead.
+    """
+    shared = Secrets()
+    shared._secrets = secrets
+    streamlit.secrets = shared
+
+def click_generate(at):
+    next(button for button in at.button if "Generate" in button.label).click()
+    at.run()
+
+def find_selectbox(at, label):
+    return next(selectbox for selectbox in at.selectbox if label in selectbox.label)
+
+def prepare_concurrent_apptest():
+    """
+    AppTest expects one test at a time. Running sessions concurrently needs:
+    - Streamlit's log level set after its config is parsed, since parsing resets it
+    - Script compilation serialized, as ast.parse can fail under concurrent use
+      on Python 3.11 ("AST constructor recursion depth mismatch")
+    - Runtime.instance() falling back to the last mock runtime, since every run
+      clears the shared singleton when it ends, even while others still run
+    - The global.appTest option kept on, since every run switches it off when it
+      ends and widgets of still-running sessions then lose their test metadata
+    """
+    # Sessions are driven from worker threads without a browser, which Streamlit warns about
+    streamlit_config.get_config_options()
+    set_log_level("error")
+    streamlit_config.set_option("global.appTest", True)
+
+    add_magic = magic.add_magic
+    compile_lock = threading.Lock()
+
+    def add_magic_serialized(code, script_path):
+        with compile_lock:
+            return add_magic(code, script_path)
+    magic.add_magic = add_magic_serialized
+
+    last_runtime = []
+    get_instance = Runtime.instance.__func__
+
+    def instance(cls):
+        if cls._instance is not None:
+            last_runtime[:] = [cls._instance]
+        elif last_runtime:
+            return last_runtime[0]
+        return get_instance(cls)
+    Runtime.instance = classmethod(instance)
+
+def run_session(timeout, scenario="mood"):
+    """
+    Runs one simulated user through the app:
+    1. Returns from the Spotify login with an auth code
+    2. Fills in the form for the scenario
+    3. Submits the form and waits for the playlist(s) to be created
+    4. For "refresh", refreshes that playlist with a second run
+    The stage check confirms the scenario's stage took effect: off-mood songs
+    removed, band songs resolved, library songs skipped, playlist refreshed,
+    one playlist created per genre or a model picked by the router.
+    Returns: Dictionary with stage latencies and success flags
+    """
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+    at.query_params["code"] = "fake-auth-code"
+
+    start = time.perf_counter()
+    at.run()
+    auth_done = time.perf_counter()
+
+    at.text_input[0].input("loadtest-user")
+    if scenario == "band":
+        at.radio[0].set_value("🎼 Music of a Band")
+        at.run()
+        at.text_input(key="band_name_input").input(FAKE_BAND)
+    else:
+        if scenario == "discovery":
+            at.radio[0].set_value("💎 Hidden Gems")
+            at.run()
+            # Give the background library index a moment to build
+            time.sleep(0.5)
+        if scenario == "auto_model":
+            find_selectbox(at, "AI Model").set_value("auto")
+        find_selectbox(at, "mood").select(random.choice(FAKE_MOODS))
+        if scenario == "fan_out":
+            for genre in random.sample(FAKE_GENRES, 2):
+                at.multiselect[0].select(genre)
+            at.run()
+            at.checkbox(key="fan_out").check()
+        else:
+            at.multiselect[0].select(random.choice(FAKE_GENRES))
+    click_generate(at)
+    if scenario == "fan_out":
+        created = any("Created 2 of 2 playlists" in element.value for element in at.success)
+    else:
+        created = any("successfully created" in element.value for element in at.success)
+
+    if scenario == "mood":
+        stage_ok = any("don't fit the mood" in element.value for element in at.info)
+    elif scenario == "band":
+        stage_ok = any("**Song " in str(element.value) for element in at.markdown)
+    elif scenario == "discovery":
+        stage_ok = any("already in your library" in element.value for element in at.info)
+    elif scenario == "fan_out":
+        stage_ok = created
+    elif scenario == "auto_model":
+        stage_ok = any("Auto-selected model" in element.value for element in at.info)
+    else:
+        at.checkbox(key="refresh_mode").check()
+        at.run()
+        click_generate(at)
+        stage_ok = any("successfully refreshed" in element.value for element in at.success)
+    end = time.perf_counter()
+
+    return {
+        "scenario": scenario,
+        "auth": auth_done - start,
+        "create": end - auth_done,
+        "total": end - start,
+        "ok": created and not at.exception,
+        "stage_ok": stage_ok
+    }
+
+# ====================================
+# RESOURCE SAMPLING
+# ====================================
+def current_rss_mb():
+    """
+    Current resident set size of this process in MB
+    (falls back to the peak RSS where /proc is unavailable)
+    """
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class ResourceSampler:
+    """
+    Samples thread count and RSS in the background while a level runs
+    """
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.peak_threads = 0
+        self.peak_rss_mb = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+            self.peak_rss_mb = max(self.peak_rss_mb, current_rss_mb())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+# ====================================
+# REPORTING
+# ====================================
+def percentile(values, pct):
+    """
+    Nearest-rank percentile of a list of numbers: the smallest value with
+    at least pct percent of the values at or below it
+    """
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    rank = math.ceil(pct * len(ordered) / 100)
+    return ordered[max(0, min(len(ordered), rank) - 1)]
+
+def run_level(concurrency, sessions, timeout, stage_totals, scenarios=SCENARIOS):
+    """
+    Runs `sessions` simulated users with `concurrency` of them active at once,
+    rotating through scenarios and adding each scenario's [stage hits, runs]
+    to stage_totals
+    Returns: Dictionary with the level's metrics
+    """
+    results = []
+    errors = 0
+    with ResourceSampler() as sampler:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [
+                executor.submit(run_session, timeout, scenarios[idx % len(scenarios)])
+                for idx in range(sessions)
+            ]
+            for future in futures:
+                try:
+                    results.append(future.result())
+                except Exception:
+                    errors += 1
+        wall = time.perf_counter() - start
+
+    totals = [result["total"] for result in results]
+    creates = [result["create"] for result in results]
+    failed = errors + sum(1 for result in results if not result["ok"])
+    for scenario in scenarios:
+        stage_runs = [result["stage_ok"] for result in results if result["scenario"] == scenario]
+        stage_totals[scenario][0] += sum(stage_runs)
+        stage_totals[scenario][1] += len(stage_runs)
+    return {
+        "concurrency": concurrency,
+        "sessions": sessions,
+        "failed": failed,
+        "throughput": (sessions - failed) / wall,
+        "p50": percentile(totals, 50),
+        "p90": percentile(totals, 90),
+        "p99": percentile(totals, 99),
+        "create_p90": percentile(creates, 90),
+        "threads": sampler.peak_threads,
+        "rss_mb": sampler.peak_rss_mb
+    }
+
+def print_report(rows):
+    """
+    Prints one line of metrics per concurrency level
+    """
+    columns = [
+        ("concurrency", "conc", 5, "d"),
+        ("sessions", "runs", 5, "d"),
+        ("failed", "fail", 5, "d"),
+        ("throughput", "sess/s", 8, ".2f"),
+        ("p50", "p50 s", 7, ".2f"),
+        ("p90", "p90 s", 7, ".2f"),
+        ("p99", "p99 s", 7, ".2f"),
+        ("create_p90", "create p90", 10, ".2f"),
+        ("threads", "threads", 7, "d"),
+        ("rss_mb", "rss MB", 8, ".1f")
+    ]
+    print("  ".join(f"{label:>{width}}" for _, label, width, _ in columns))
+    for row in rows:
+        print("  ".join(f"{row[key]:>{width}{spec}}" for key, _, width, spec in columns))
+
+def print_stage_report(stage_totals, hits):
+    """
+    Prints how often each scenario's stage took effect and the Spotify
+    endpoints the sessions reached
+    """
+    print("\nStage checks:")
+    for scenario, (passed, runs) in stage_totals.items():
+        print(f"  {scenario:<10} {passed}/{runs}")
+    print("\nSpotify requests:")
+    for route, count in sorted(hits.items()):
+        print(f"  {count:>6}  {route}")
+
+# ====================================
+# ENTRY POINT
+# ====================================
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent-session load test for ListCreator2.py")
+    parser.add_argument("--levels", default="1,5,10,25", help="Comma-separated concurrency levels")
+    parser.add_argument("--sessions", type=int, default=None, help="Sessions per level (default: 2x the level)")
+    parser.add_argument("--spotify-latency", type=float, default=0.08, help="Mean fake Spotify latency in seconds")
+    parser.add_argument("--llm-latency", type=float, default=4.0, help="Mean fake LLM latency in seconds")
+    parser.add_argument("--mongo-latency", type=float, default=0.02, help="Mean fake MongoDB insert latency in seconds")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Per-run script timeout in seconds")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Comma-separated scenarios to rotate through")
+    parser.add_argument("--flags", default="", help="Comma-separated extra feature flags to enable for every session, "
+                        "e.g. progressive_rendering,sharded_generation")
+    args = parser.parse_args()
+    scenarios = [scenario for scenario in args.scenarios.split(",") if scenario]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    extra_flags = [flag for flag in args.flags.split(",") if flag]
+    for scenario in scenarios:
+        extra_flags.extend(SCENARIO_FLAGS.get(scenario, []))
+
+    prepare_concurrent_apptest()
+
+    # Spawn rather than fork: this process already runs Streamlit threads
+    fakes_context = multiprocessing.get_context("spawn")
+    conn, fakes_conn = fakes_context.Pipe()
+    fakes = fakes_context.Process(
+        target=serve_fakes,
+        args=(fakes_conn, args.spotify_latency, args.llm_latency, args.mongo_latency),
+        daemon=True
+    )
+    fakes.start()
+    spotify_url, llm_url, mongo_url = conn.recv()
+    install_secrets(build_secrets(spotify_url, llm_url, mongo_url, extra_flags))
+
+    rows = []
+    stage_totals = {scenario: [0, 0] for scenario in scenarios}
+    try:
+        for level in (int(value) for value in args.levels.split(",")):
+            sessions = args.sessions or level * 2
+            print(f"Running {sessions} sessions at concurrency {level}...", flush=True)
+            rows.append(run_level(level, sessions, args.timeout, stage_totals, scenarios))
+    finally:
+        conn.send("stop")
+        hits, inserted = conn.recv()
+        fakes.join()
+
+    print()
+    if extra_flags:
+        print(f"Extra feature flags: {', '.join(dict.fromkeys(extra_flags))}\n")
+    print_report(rows)
+    print_stage_report(stage_totals, hits)
+    print(f"\nMongoDB documents inserted: {inserted}")
+
+if __name__ == "__main__":
+    main()